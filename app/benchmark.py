@@ -0,0 +1,341 @@
+"""
+Reproducible benchmarks for ingestion, retrieval, classification and /query
+
+Run from the app directory, e.g.:
+
+    python benchmark.py --suites extraction search --sizes 1000 10000 100000 --output bench.json
+    python benchmark.py --suites query --url http://localhost:8000 --concurrency 8 --requests 200
+    python benchmark.py --suites search --compare bench.json
+
+Every suite is seeded and writes plain numbers into one JSON document, so two
+runs (e.g. before and after a change) can be compared with --compare.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+import numpy as np
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+DEFAULT_PDF = os.path.join(DATA_DIR, "ctg-studies.pdf")
+LOCAL_SUITES = ("extraction", "ingestion", "search", "classifier")
+SUITES = LOCAL_SUITES + ("query",)
+
+SAMPLE_QUERIES = [
+    "What are the eligibility criteria for the clinical trials?",
+    "Which treatments were studied for patients with diabetes?",
+    "What adverse events were reported during the study?",
+    "How can irrigation improve crop yields in dry regions?",
+    "What policies reduce food insecurity and malnutrition?",
+    "How does climate change affect livestock production?",
+    "What is artificial intelligence used for in business?",
+    "Explain how the internet routes data between computers",
+]
+
+def latency_summary(latencies_ms):
+    """Mean and tail percentiles of a list of millisecond latencies"""
+    values = np.asarray(latencies_ms, dtype=np.float64)
+    if not len(values):
+        return {"count": 0}
+    return {
+        "count": int(len(values)),
+        "mean_ms": round(float(values.mean()), 4),
+        "p50_ms": round(float(np.percentile(values, 50)), 4),
+        "p95_ms": round(float(np.percentile(values, 95)), 4),
+        "p99_ms": round(float(np.percentile(values, 99)), 4),
+        "max_ms": round(float(values.max()), 4)
+    }
+
+def timed(fn, *args, **kwargs):
+    """(result, elapsed milliseconds) of one call"""
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, (time.perf_counter() - start) * 1000
+
+def run_metadata(args):
+    """Environment details recorded alongside results, so runs are comparable"""
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "git_commit": commit,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "args": {key: value for key, value in vars(args).items() if key not in ("output", "compare")}
+    }
+
+def synthetic_corpus(size, dim=1024, n_topics=64, words_per_doc=60, seed=0):
+    """
+    Seeded corpus with clustered unit-norm embeddings and Zipf-distributed words
+
+    Returns:
+        (documents, rng) where documents are {"content", "embedding", "metadata"} dicts
+    """
+    rng = np.random.default_rng(seed)
+    vocabulary = np.array([f"term{i}" for i in range(5000)])
+    word_ids = np.minimum(rng.zipf(1.3, size=(size, words_per_doc)) - 1, len(vocabulary) - 1)
+
+    centers = rng.standard_normal((n_topics, dim)).astype(np.float32)
+    embeddings = centers[rng.integers(0, n_topics, size)] + 0.6 * rng.standard_normal((size, dim)).astype(np.float32)
+    embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+    documents = [
+        {"content": " ".join(vocabulary[word_ids[i]]), "embedding": embeddings[i], "metadata": {"id": i}}
+        for i in range(size)
+    ]
+    return documents, rng
+
+def bench_extraction(args):
+    """Page extraction and chunking throughput on the bundled PDF (no model needed)"""
+    from pypdf import PdfReader
+    from utils.document_processor import DocumentProcessor
+
+    # Chunking never touches the model, so a placeholder avoids loading E5
+    processor = DocumentProcessor(embedding_model=object())
+
+    pages = len(PdfReader(args.pdf).pages)
+    start = time.perf_counter()
+    chunks = list(processor._iter_chunks_from_pdf(args.pdf))
+    seconds = time.perf_counter() - start
+    return {
+        "pdf": os.path.basename(args.pdf),
+        "pages": pages,
+        "chunks": len(chunks),
+        "workers": processor.extraction_workers,
+        "seconds": round(seconds, 4),
+        "pages_per_s": round(pages / seconds, 2),
+        "chunks_per_s": round(len(chunks) / seconds, 2)
+    }
+
+def bench_ingestion(args, embedding_model):
+    """Full PDF ingestion (extract, embed, save) into a scratch store"""
+    from utils.document_processor import DocumentProcessor
+
+    processor = DocumentProcessor(embedding_model)
+    with tempfile.TemporaryDirectory() as scratch:
+        start = time.perf_counter()
+        store = processor.process_pdf(args.pdf, os.path.join(scratch, "bench.store"), "benchmark")
+        seconds = time.perf_counter() - start
+        store_bytes = sum(
+            os.path.getsize(os.path.join(root, name))
+            for root, _, names in os.walk(scratch) for name in names
+        )
+    return {
+        "pdf": os.path.basename(args.pdf),
+        "chunks": len(store),
+        "seconds": round(seconds, 4),
+        "chunks_per_s": round(len(store) / seconds, 2),
+        "store_mb": round(store_bytes / 1024 ** 2, 2),
+        "last_embedding_batch": embedding_model.last_bulk_stats
+    }
+
+def bench_search(args):
+    """Search latency (and recall against exact scoring) per corpus size and index backend"""
+    from utils.search_engine import SearchEngine
+
+    results = {}
+    for size in args.sizes:
+        documents, rng = synthetic_corpus(size, dim=args.dim, seed=args.seed)
+        query_rows = rng.choice(size, size=args.queries, replace=args.queries > size)
+        query_embeddings = np.stack([documents[i]["embedding"] for i in query_rows])
+        query_embeddings += rng.normal(scale=0.02, size=query_embeddings.shape).astype(np.float32)
+        query_texts = [" ".join(documents[i]["content"].split()[:6]) for i in query_rows]
+
+        exact_ids = None
+        for backend in args.backends:
+            engine, build_ms = timed(SearchEngine, {"synthetic": documents}, index_backend=backend)
+
+            for text, embedding in zip(query_texts[:args.warmup], query_embeddings):
+                engine.search(text, domain="synthetic", query_embedding=embedding)
+
+            latencies, found = [], []
+            for text, embedding in zip(query_texts, query_embeddings):
+                hits, ms = timed(engine.search, text, domain="synthetic", top_k=5, query_embedding=embedding)
+                latencies.append(ms)
+                found.append({hit["metadata"].get("id") for hit in hits})
+
+            batch_results, batch_ms = timed(
+                engine.search_batch, query_texts, ["synthetic"] * len(query_texts),
+                top_k=5, query_embeddings=query_embeddings
+            )
+
+            entry = {
+                "size": size,
+                "backend": backend,
+                "build_ms": round(build_ms, 2),
+                "search": latency_summary(latencies),
+                "qps": round(len(latencies) / (sum(latencies) / 1000), 2),
+                "batch_qps": round(len(batch_results) / (batch_ms / 1000), 2)
+            }
+            if backend == "exact":
+                exact_ids = found
+            elif exact_ids is not None:
+                overlap = sum(len(a & b) for a, b in zip(exact_ids, found))
+                entry["recall_at_5"] = round(overlap / max(1, sum(len(ids) for ids in exact_ids)), 4)
+
+            results[f"{backend}@{size}"] = entry
+            print(json.dumps(entry))
+    return results
+
+def bench_classifier(args, embedding_model):
+    """Query embedding and domain classification latency"""
+    from utils.domain_classifier import DomainClassifier
+
+    classifier = DomainClassifier(embedding_model)
+    queries = [SAMPLE_QUERIES[i % len(SAMPLE_QUERIES)] + f" ({i})" for i in range(args.queries)]
+
+    embed_latencies, embeddings = [], []
+    for query in queries:
+        embedding, ms = timed(embedding_model.get_query_embedding, query)
+        embed_latencies.append(ms)
+        embeddings.append(embedding)
+    embeddings = np.stack(embeddings)
+
+    classify_latencies = [
+        timed(classifier.classify_query, query, query_embedding=embedding)[1]
+        for query, embedding in zip(queries, embeddings)
+    ]
+    _, batch_ms = timed(classifier.classify_queries, queries, query_embeddings=embeddings)
+    _, batch_embed_ms = timed(embedding_model.get_query_embeddings, queries[:32])
+
+    return {
+        "query_embedding": latency_summary(embed_latencies),
+        "batched_embedding_per_query_ms": round(batch_embed_ms / len(queries[:32]), 4),
+        "classify_precomputed": latency_summary(classify_latencies),
+        "classify_batch_per_query_ms": round(batch_ms / len(queries), 4)
+    }
+
+def bench_query(args):
+    """End-to-end /query latency and throughput under a concurrent load generator"""
+    endpoint = args.url.rstrip("/") + "/query"
+
+    def send(i):
+        query = SAMPLE_QUERIES[i % len(SAMPLE_QUERIES)]
+        # With --bypass-cache the server skips the exact and semantic response
+        # caches, so every request is generated
+        body = json.dumps({"query": query, "max_length": args.max_length,
+                           "bypass_cache": args.bypass_cache}).encode()
+        request = urllib.request.Request(endpoint, data=body, headers={"Content-Type": "application/json"})
+        start = time.perf_counter()
+        try:
+            with urllib.request.urlopen(request, timeout=args.timeout) as response:
+                response.read()
+                status = response.status
+        except urllib.error.HTTPError as e:
+            status = e.code
+        except (urllib.error.URLError, TimeoutError):
+            status = None
+        return status, (time.perf_counter() - start) * 1000
+
+    for i in range(args.warmup):
+        send(i)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        outcomes = list(pool.map(send, range(args.requests)))
+    wall_seconds = time.perf_counter() - start
+
+    statuses = {}
+    for status, _ in outcomes:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    ok_latencies = [ms for status, ms in outcomes if status == 200]
+
+    return {
+        "url": endpoint,
+        "concurrency": args.concurrency,
+        "bypass_cache": args.bypass_cache,
+        "requests": args.requests,
+        "wall_seconds": round(wall_seconds, 4),
+        "throughput_rps": round(len(ok_latencies) / wall_seconds, 2),
+        "statuses": statuses,
+        "latency": latency_summary(ok_latencies)
+    }
+
+def flatten(results, prefix=""):
+    """Numeric leaves of a nested result dict, keyed by dotted path"""
+    flat = {}
+    for key, value in results.items():
+        path = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{path}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[path] = value
+    return flat
+
+def compare(previous, current):
+    """Print each shared metric with its relative change against a previous run"""
+    before, after = flatten(previous["results"]), flatten(current["results"])
+    print(f"Comparing against {previous['meta'].get('git_commit')} ({previous['meta'].get('timestamp')})")
+    for key in sorted(before.keys() & after.keys()):
+        old, new = before[key], after[key]
+        change = f"{(new - old) / old * 100:+.1f}%" if old else "n/a"
+        print(f"  {key}: {old} -> {new} ({change})")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark ingestion, search, classification and /query")
+    parser.add_argument("--suites", nargs="+", choices=SUITES, default=list(LOCAL_SUITES))
+    parser.add_argument("--pdf", default=DEFAULT_PDF)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--backends", nargs="+", default=["exact", "binary", "projection", "hnsw"],
+                        help="SearchEngine index backends (exact first to measure recall)")
+    parser.add_argument("--dim", type=int, default=1024)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--warmup", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--embedding-backend", default=os.getenv("EMBEDDING_BACKEND", "torch"))
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--max-length", type=int, default=128)
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--bypass-cache", action="store_true",
+                        help="Ask /query to skip its response caches so generation is measured")
+    parser.add_argument("--output", help="Write results as JSON to this path")
+    parser.add_argument("--compare", help="Previous JSON results to compare against")
+    args = parser.parse_args()
+
+    embedding_model = None
+    if {"ingestion", "classifier"} & set(args.suites):
+        from utils.custom_embeddings import get_embedding_model
+        embedding_model = get_embedding_model(backend=args.embedding_backend)
+
+    results = {}
+    for suite in args.suites:
+        print(f"Running {suite} benchmark...")
+        if suite == "extraction":
+            results[suite] = bench_extraction(args)
+        elif suite == "ingestion":
+            results[suite] = bench_ingestion(args, embedding_model)
+        elif suite == "search":
+            results[suite] = bench_search(args)
+        elif suite == "classifier":
+            results[suite] = bench_classifier(args, embedding_model)
+        else:
+            results[suite] = bench_query(args)
+
+    report = {"meta": run_metadata(args), "results": results}
+    print(json.dumps(report, indent=2))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+
+if __name__ == "__main__":
+    main()
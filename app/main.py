@@ -1,20 +1,60 @@
 # app/main.py
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from starlette.concurrency import iterate_in_threadpool
+from pydantic import BaseModel, Field
 from typing import Dict, List, Any, Optional
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+import asyncio
+import json
 import os
+import threading
+import numpy as np
 
 from utils.document_processor import DocumentProcessor
 from utils.search_engine import SearchEngine
-from utils.text_generation import TextGenerator
+from utils.sharded_search import ShardedSearchEngine
+from utils.sketch_index import SKETCH_KINDS
+from utils.text_generation import TextGenerator, NO_CONTEXT_RESPONSE
+from utils.generation_scheduler import GenerationScheduler
 from utils.domain_classifier import DomainClassifier
-from utils.custom_embeddings import E5EmbeddingModel
+from utils.custom_embeddings import get_embedding_model, get_model_memory_report, SERVING_BACKENDS
+from utils.embedding_batcher import QueryEmbeddingBatcher
+from utils.vector_store import VectorStore, load_vector_store, is_vector_store, link_vector_store
+from utils.ingestion import StoreVersions, IngestionQueue
+from utils.execution import InferenceExecutor, StageOverloadedError, StageTimeoutError
+from utils.cache import LRUCache, QueryEmbeddingCache, SemanticResponseCache, normalize_query
+from utils.query_pipeline import BatchQueryPipeline, force_general_domain, needs_general_fallback, retrieval_path
+from utils.metrics import MetricsRegistry, RequestTimer
+
+# Startup progress per component: "pending", "loading", "ready" or "failed: <error>"
+startup_status = {}
+
+def set_status(component, status):
+    startup_status[component] = status
+    print(f"Startup: {component} {status}")
+
+def is_ready(component):
+    return startup_status.get(component) == "ready"
+
+@asynccontextmanager
+async def lifespan(app):
+    """Bind immediately and load models and domains in the background"""
+    startup = asyncio.create_task(load_components())
+    yield
+    startup.cancel()
+    inference_executor.shutdown()
+    startup_pool.shutdown(wait=False)
+    search_engine.shutdown()
+    ingestion_queue.shutdown()
 
 app = FastAPI(
     title="NewWebCo AI Agents API",
     description="API for orchestrating AI agents for productivity enhancement",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 # Configure CORS
@@ -26,9 +66,20 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Initialize components
-document_processor = DocumentProcessor()
-classifier = DomainClassifier()
+# Caches: normalized query -> embedding, and (query, domain, index version) -> response
+embedding_cache = QueryEmbeddingCache(max_size=int(os.getenv("EMBEDDING_CACHE_SIZE", "4096")))
+response_cache = LRUCache(
+    max_size=int(os.getenv("RESPONSE_CACHE_SIZE", "1024")),
+    ttl=float(os.getenv("RESPONSE_CACHE_TTL_S", "600"))
+)
+# Reuses answers for paraphrases whose query embeddings are near-identical. E5 similarities
+# run high, so questions differing only in an entity (drug X vs drug Y) can clear 0.95;
+# raise SEMANTIC_CACHE_THRESHOLD (or set it above 1 to disable the cache) if that matters
+semantic_cache = SemanticResponseCache(
+    max_size=int(os.getenv("SEMANTIC_CACHE_SIZE", "2048")),
+    ttl=float(os.getenv("RESPONSE_CACHE_TTL_S", "600")),
+    threshold=float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.95"))
+)
 
 # Setup paths
 data_dir = os.path.join(os.path.dirname(__file__), "data")
@@ -51,50 +102,396 @@ DOMAINS = {
     }
 }
 
-# Initialize with domain awareness
-document_collections = {}
+# Search engine starts empty; each domain is swapped in as soon as it has loaded
+# (INDEX_BACKEND=ivf|hnsw switches large corpora to a FAISS index,
+#  INDEX_BACKEND=binary|projection to sketch prefilter + exact rerank)
+index_backend = os.getenv("INDEX_BACKEND", "exact")
+if index_backend in SKETCH_KINDS:
+    index_params = {"sketch_dim": int(os.getenv("SKETCH_DIM", "128"))} if index_backend == "projection" else {}
+else:
+    index_params = {
+        "nprobe": int(os.getenv("INDEX_NPROBE", "8")),
+        "ef_search": int(os.getenv("INDEX_EF_SEARCH", "64"))
+    }
+search_options = {
+    "index_backend": index_backend,
+    "index_params": index_params,
+    "rerank_candidates": int(os.getenv("RERANK_CANDIDATES", "300"))
+}
+# SEARCH_SHARD_WORKERS>0 scores domain stores in that many worker processes sharing
+# the memory-mapped stores, with the API process merging each shard's top-k
+shard_workers = int(os.getenv("SEARCH_SHARD_WORKERS", "0"))
+if shard_workers > 0:
+    search_engine = ShardedSearchEngine(
+        {},
+        workers=shard_workers,
+        rows_per_shard=int(os.getenv("SEARCH_SHARD_ROWS", "0")) or None,
+        **search_options
+    )
+else:
+    search_engine = SearchEngine({}, **search_options)
+search_engine.set_embedding_cache(embedding_cache)
+pdf_stores = []  # per-PDF stores loaded at startup before the generator, attached once it is up
+
+# Domains ingested through /ingest are served from numbered store versions
+# (vector_db/versions/<domain>/v<N>/); the others from the stores configured in DOMAINS
+store_versions = StoreVersions(
+    os.path.join(vector_db_dir, "versions"), keep=int(os.getenv("STORE_VERSIONS_KEEP", "3"))
+)
+# Background ingestion and rollback jobs, one at a time
+ingestion_queue = IngestionQueue()
+
+# Bounded worker pools so model inference never blocks the event loop
+generate_workers = int(os.getenv("GENERATE_WORKERS", "2"))
+inference_executor = InferenceExecutor({
+    "embed": {
+        "workers": int(os.getenv("EMBED_WORKERS", "1")),
+        "max_pending": int(os.getenv("EMBED_MAX_PENDING", "64")),
+        "timeout": float(os.getenv("EMBED_TIMEOUT_S", "10"))
+    },
+    "retrieve": {
+        "workers": int(os.getenv("RETRIEVE_WORKERS", str(os.cpu_count() or 2))),
+        "max_pending": int(os.getenv("RETRIEVE_MAX_PENDING", "64")),
+        "timeout": float(os.getenv("RETRIEVE_TIMEOUT_S", "10"))
+    },
+    "generate": {
+        "workers": generate_workers,
+        "max_pending": int(os.getenv("GENERATE_MAX_PENDING", "16")),
+        "timeout": float(os.getenv("GENERATE_TIMEOUT_S", "60"))
+    }
+})
+
+# Model-backed components, set by the background startup tasks below
+embedding_model = None
+document_processor = None
+classifier = None
+query_batcher = None
+text_generator = None
+generation_scheduler = None
+batch_pipeline = None
+
+# Threads for blocking startup work: both models and every domain load at once
+startup_pool = ThreadPoolExecutor(max_workers=len(DOMAINS) + 2, thread_name_prefix="startup")
+# Domains finishing together must not interleave centroid refits
+centroid_lock = threading.Lock()
+
+set_status("embedding_model", "pending")
+set_status("text_generator", "pending")
+set_status("batch_pipeline", "pending")
+for domain_name in DOMAINS:
+    set_status(f"domain:{domain_name}", "pending")
 
-# Process each domain's documents
-for domain_name, domain_info in DOMAINS.items():
-    domain_pdfs = domain_info["pdf_files"]
-    domain_docs = []
+def load_embedding_components():
+    """Load the shared E5 model and the components built on it (blocking)"""
+    global embedding_model, document_processor, classifier, query_batcher
     
-    for pdf_file in domain_pdfs:
+    # Initialize components (all share one process-wide E5 model)
+    # (EMBEDDING_BACKEND=int8 selects a faster CPU inference backend)
+    embedding_backend = os.getenv("EMBEDDING_BACKEND", "torch")
+    if embedding_backend not in SERVING_BACKENDS:
+        raise ValueError(f"EMBEDDING_BACKEND must be one of {', '.join(SERVING_BACKENDS)}, not {embedding_backend}")
+    embedding_model = get_embedding_model(backend=embedding_backend)
+    # Sharded search leaves chunk texts memory-mapped in this process; workers do the scoring
+    document_processor = DocumentProcessor(embedding_model, lazy_texts=shard_workers > 0)
+    classifier = DomainClassifier(embedding_model, embedding_cache=embedding_cache)
+    search_engine.set_embedding_model(embedding_model)
+    
+    # Coalesce concurrent query embeddings into shared forward passes
+    query_batcher = QueryEmbeddingBatcher(
+        embedding_model,
+        max_batch_size=int(os.getenv("EMBED_BATCH_MAX_SIZE", "16")),
+        max_wait_ms=float(os.getenv("EMBED_BATCH_MAX_WAIT_MS", "5")),
+        runner=lambda fn, *args: inference_executor.run("embed", fn, *args),
+        # Queries queue here rather than in the executor, so the backpressure limit applies here
+        max_pending=int(os.getenv("EMBED_MAX_PENDING", "64"))
+    )
+
+def load_text_generator():
+    """Load the T5 generator and its batching scheduler (blocking)"""
+    global text_generator, generation_scheduler
+    
+    # Initialize text generator (LLM)
+    text_generator = TextGenerator(context_cache_size=int(os.getenv("CONTEXT_TOKEN_CACHE_CHUNKS", "20000")))
+    
+    # Batch concurrently pending prompts into shared generate() calls
+    generation_scheduler = GenerationScheduler(
+        text_generator,
+        max_batch_size=int(os.getenv("GENERATE_BATCH_MAX_SIZE", "8")),
+        max_wait_ms=float(os.getenv("GENERATE_BATCH_MAX_WAIT_MS", "20")),
+        max_concurrent_batches=generate_workers,
+        runner=lambda fn, *args: inference_executor.run("generate", fn, *args),
+        # Requests queue here rather than in the executor, so the backpressure limits apply here
+        max_pending=int(os.getenv("GENERATE_MAX_PENDING", "16")),
+        timeout=float(os.getenv("GENERATE_TIMEOUT_S", "60"))
+    )
+
+def load_domain(domain_name):
+    """Load (ingesting if needed) a domain's stores and publish its index (blocking)"""
+    version = store_versions.current_version(domain_name)
+    if version is not None:
+        # Published versions are immutable, so their stores are opened as-is
+        domain_stores = load_version_stores(domain_name, version)
+        publish_domain(domain_name, domain_stores)
+        print(f"Ready {domain_name} store version {version}")
+        return domain_stores
+    
+    domain_stores = []
+    
+    for pdf_file in DOMAINS[domain_name]["pdf_files"]:
         pdf_path = os.path.join(data_dir, pdf_file)
-        vector_db_path = os.path.join(vector_db_dir, f"{domain_name}_{pdf_file}.pkl")
+        vector_db_path = os.path.join(vector_db_dir, f"{domain_name}_{pdf_file}.store")
+        legacy_pickle_path = os.path.join(vector_db_dir, f"{domain_name}_{pdf_file}.pkl")
         
         if os.path.exists(pdf_path):
-            if os.path.exists(vector_db_path):
-                # Load existing embeddings
-                domain_docs.extend(document_processor.load_vector_store(vector_db_path))
-                print(f"Loaded {pdf_file} embeddings for {domain_name}")
+            if not os.path.exists(vector_db_path) and os.path.exists(legacy_pickle_path):
+                # One-time conversion of a pickle store written by an older version
+                document_processor.migrate_pickle_store(legacy_pickle_path, vector_db_path)
+                print(f"Migrated {pdf_file} embeddings for {domain_name}")
+            
+            # Loads the store as-is when the PDF, chunker and model are unchanged,
+            # otherwise re-embeds only new or changed chunks
+            domain_stores.append(document_processor.process_pdf(pdf_path, vector_db_path, domain_name))
+            print(f"Ready {pdf_file} embeddings for {domain_name}")
+    
+    publish_domain(domain_name, domain_stores)
+    return domain_stores
+
+def publish_domain(domain_name, domain_stores):
+    """Swap a domain's stores into the search engine; in-flight searches finish on the old index"""
+    # Sharded search keeps per-PDF stores separate so workers can map them directly
+    search_engine.update_collection(
+        domain_name, domain_stores if shard_workers > 0 else VectorStore.concatenate(domain_stores)
+    )
+    
+    # CLASSIFIER_CENTROIDS=chunks routes by the mean of each domain's stored chunk embeddings
+    # instead of its hand-written description (domains without documents keep the description)
+    if os.getenv("CLASSIFIER_CENTROIDS", "description") == "chunks":
+        with centroid_lock:
+            classifier.fit_centroids({
+                name: index.embedding_blocks() for name, index in search_engine.indexes.items()
+            })
+
+def legacy_store_path(domain_name, pdf_file):
+    return os.path.join(vector_db_dir, f"{domain_name}_{pdf_file}.store")
+
+def load_version_stores(domain_name, version):
+    """Open every per-PDF store of a published version"""
+    manifest = store_versions.manifest(domain_name, version)
+    paths = [store_versions.store_path(domain_name, version, pdf_file) for pdf_file in manifest["pdf_files"]]
+    return [load_vector_store(path, lazy_texts=shard_workers > 0) for path in paths if is_vector_store(path)]
+
+def domain_pdf_files(domain_name):
+    """PDFs the live version of a domain was built from"""
+    manifest = store_versions.current(domain_name)
+    return manifest["pdf_files"] if manifest else DOMAINS[domain_name]["pdf_files"]
+
+def activate_version(domain_name, version):
+    """Serve a published version: swap its index in, then move the CURRENT pointer (blocking)"""
+    stores = load_version_stores(domain_name, version)
+    publish_domain(domain_name, stores)
+    store_versions.activate(domain_name, version)
+    
+    # Not kept anywhere else: the replaced version's stores are released with its index
+    if is_ready("text_generator"):
+        attach_stores(stores)
+    return {"version": version, "documents": sum(len(store) for store in stores)}
+
+def build_domain_version(domain_name, pdf_files):
+    """
+    Ingest a domain's PDFs into a new store version off to the side, then activate it (blocking)
+    
+    Each store starts as a hard-linked copy of the live one, so only new or
+    changed chunks are embedded; queries keep using the live version until the swap.
+    """
+    if store_versions.current_version(domain_name) is None:
+        # First ingestion: snapshot the configured stores as a baseline to roll back to
+        baseline = store_versions.begin(domain_name)
+        linked = []
+        for pdf_file in DOMAINS[domain_name]["pdf_files"]:
+            if is_vector_store(legacy_store_path(domain_name, pdf_file)):
+                link_vector_store(
+                    legacy_store_path(domain_name, pdf_file),
+                    store_versions.store_path(domain_name, baseline, pdf_file, building=True)
+                )
+                linked.append(pdf_file)
+        store_versions.publish(domain_name, baseline, linked, source="baseline")
+        store_versions.activate(domain_name, baseline)
+    
+    live = store_versions.current_version(domain_name)
+    version = store_versions.begin(domain_name)
+    try:
+        published = []
+        for pdf_file in pdf_files:
+            path = store_versions.store_path(domain_name, version, pdf_file, building=True)
+            live_path = store_versions.store_path(domain_name, live, pdf_file)
+            if is_vector_store(live_path):
+                link_vector_store(live_path, path)
+            if os.path.isfile(os.path.join(data_dir, pdf_file)):
+                document_processor.process_pdf(os.path.join(data_dir, pdf_file), path, domain_name)
+            elif is_vector_store(live_path):
+                # The source PDF is gone from data/; keep serving its existing store
+                print(f"{pdf_file} is no longer in the data directory, keeping its live store")
             else:
-                # Process new PDF with domain awareness
-                new_docs = document_processor.process_pdf(pdf_path, vector_db_path, domain_name)
-                domain_docs.extend(new_docs)
-                print(f"Created embeddings for {pdf_file} in {domain_name} domain")
+                print(f"Skipping {pdf_file}: neither the PDF nor a live store exists")
+                continue
+            published.append(pdf_file)
+        store_versions.publish(domain_name, version, published, source="ingest")
+    except Exception:
+        store_versions.discard(domain_name, version)
+        raise
     
-    document_collections[domain_name] = domain_docs
+    result = activate_version(domain_name, version)
+    store_versions.prune(domain_name)
+    return result
 
-# Initialize search engine with document collections
-search_engine = SearchEngine(document_collections)
-embedding_model = E5EmbeddingModel()
-search_engine.set_embedding_model(embedding_model)
+def attach_stores(stores):
+    """Pre-tokenize every chunk once (persisted next to each store) for prompt packing"""
+    if shard_workers > 0:
+        # A sharded corpus need not fit in this process; retrieved chunks are tokenized on first sight
+        return
+    for store in stores:
+        text_generator.context_builder.attach_store(store)
 
-# Initialize text generator (LLM)
-text_generator = TextGenerator()
+async def run_startup_step(component, fn, *args):
+    """Run one blocking startup step on the startup pool, tracking its status"""
+    set_status(component, "loading")
+    try:
+        result = await asyncio.get_running_loop().run_in_executor(startup_pool, fn, *args)
+    except Exception as e:
+        set_status(component, f"failed: {str(e)}")
+        raise
+    set_status(component, "ready")
+    return result
+
+async def load_components():
+    """Load both models concurrently, then every domain concurrently, publishing each when done"""
+    loop = asyncio.get_running_loop()
+    generator_step = asyncio.ensure_future(run_startup_step("text_generator", load_text_generator))
+    
+    async def load_and_attach(domain_name):
+        stores = await run_startup_step(f"domain:{domain_name}", load_domain, domain_name)
+        if is_ready("text_generator"):
+            await loop.run_in_executor(startup_pool, attach_stores, stores)
+        else:
+            pdf_stores.extend(stores)
+    
+    try:
+        # Domains need the embedding model to check or build their stores
+        await run_startup_step("embedding_model", load_embedding_components)
+        domain_steps = [asyncio.ensure_future(load_and_attach(name)) for name in DOMAINS]
+        
+        await generator_step
+        
+        global batch_pipeline
+        # Bulk answering for offline evaluation (also usable directly: batch_pipeline.run(requests))
+        batch_pipeline = BatchQueryPipeline(
+            embedding_model,
+            classifier,
+            search_engine,
+            text_generator,
+            embedding_cache=embedding_cache,
+            chunk_size=int(os.getenv("QUERY_BATCH_CHUNK_SIZE", "32")),
+            generation_batch_size=int(os.getenv("GENERATE_BATCH_MAX_SIZE", "8"))
+        )
+        set_status("batch_pipeline", "ready")
+        
+        # Domains loaded before the generator was up are attached now, later ones as they finish
+        attach_now = list(pdf_stores)
+        pdf_stores.clear()
+        await loop.run_in_executor(startup_pool, attach_stores, attach_now)
+        
+        await asyncio.gather(*domain_steps, return_exceptions=True)
+    except Exception as e:
+        print(f"Startup failed: {str(e)}")
+    print("Startup finished: " + ", ".join(f"{name} {status}" for name, status in startup_status.items()))
+
+def require_ready(*components):
+    """Reject a request with 503 while a component it needs is still loading"""
+    for component in components:
+        if not is_ready(component):
+            status = startup_status.get(component, "unknown")
+            raise HTTPException(
+                status_code=503,
+                detail=f"{component} is not ready ({status})",
+                headers={"Retry-After": "5"}
+            )
+
+# Prometheus metrics: per-stage latency histograms, request counters and memory gauges
+metrics = MetricsRegistry()
+stage_seconds = metrics.histogram(
+    "rag_stage_seconds", "Time spent in each query pipeline stage", ("stage", "domain", "endpoint")
+)
+request_seconds = metrics.histogram(
+    "rag_request_seconds", "End-to-end query latency", ("endpoint",)
+)
+requests_total = metrics.counter(
+    "rag_requests_total", "Answered queries by domain and retrieval path", ("endpoint", "domain", "path")
+)
+errors_total = metrics.counter(
+    "rag_request_errors_total", "Failed queries by HTTP status", ("endpoint", "status")
+)
+metrics.gauge(
+    "rag_component_ready", "1 once a model or domain has finished loading", ("component",),
+    callback=lambda: {component: int(status == "ready") for component, status in startup_status.items()}
+)
+metrics.gauge(
+    "rag_model_memory_megabytes", "Resident weight memory per loaded embedding model", ("model",),
+    callback=get_model_memory_report
+)
+metrics.gauge(
+    "rag_index_memory_bytes", "Embedding matrix, BM25 and sketch bytes per domain index", ("domain",),
+    callback=lambda: {domain: index.memory_bytes() for domain, index in search_engine.indexes.items()}
+)
+metrics.gauge(
+    "rag_index_documents", "Indexed chunks per domain", ("domain",),
+    callback=lambda: {domain: len(index) for domain, index in search_engine.indexes.items()}
+)
+metrics.gauge(
+    "rag_store_version", "Live store version per ingested domain", ("domain",),
+    callback=lambda: {
+        name: store_versions.current_version(name) for name in DOMAINS
+        if store_versions.current_version(name) is not None
+    }
+)
+metrics.gauge(
+    "rag_ingestion_jobs_pending", "Ingestion and rollback jobs queued or running",
+    callback=ingestion_queue.pending
+)
+metrics.gauge(
+    "rag_cache_entries", "Entries held per cache", ("cache",),
+    callback=lambda: {"embedding": len(embedding_cache), "response": len(response_cache),
+                      "semantic": len(semantic_cache)}
+)
+metrics.gauge(
+    "rag_stage_pending", "Calls queued or running per executor stage", ("stage",),
+    callback=lambda: {stage: stats["pending"] for stage, stats in inference_executor.get_stats().items()}
+)
 
 # Define request/response models
 class QueryRequest(BaseModel):
     query: str
     context: Optional[Dict[str, Any]] = None
     conversation_id: Optional[str] = None
+    # Generated tokens (default 256); bounded, since a batch generates to its longest request
+    max_length: Optional[int] = Field(default=None, ge=1, le=512)
+    include_timings: bool = False
+    # Skip both response caches, e.g. to measure generation when benchmarking
+    bypass_cache: bool = False
 
 class QueryResponse(BaseModel):
     response: str
     sources: List[Dict[str, Any]]
     domain: str
     confidence: float
+    timings: Optional[Dict[str, float]] = None
+
+class IngestRequest(BaseModel):
+    domain: str
+    pdf_files: List[str] = []  # file names in app/data
+    replace: bool = False  # True: serve exactly these PDFs; False: add them to the live set
+
+class RollbackRequest(BaseModel):
+    version: Optional[int] = None  # defaults to the version before the live one
 
 @app.get("/")
 async def root():
@@ -102,66 +499,447 @@ async def root():
 
 @app.get("/health")
 async def health_check():
+    """Liveness and runtime stats; answers immediately, even while still loading"""
+    ready = all(status == "ready" for status in startup_status.values())
     return {
-        "status": "healthy",
-        "document_collections": list(document_collections.keys())
+        "status": "healthy" if ready else "starting",
+        "startup": dict(startup_status),
+        "document_collections": list(search_engine.document_collections.keys()),
+        "model_memory_mb": get_model_memory_report(),
+        "embedding_batcher": query_batcher.get_stats() if query_batcher else None,
+        "executor": inference_executor.get_stats(),
+        "generation_scheduler": generation_scheduler.get_stats() if generation_scheduler else None,
+        "cache": {
+            "embedding": embedding_cache.get_stats(),
+            "response": response_cache.get_stats(),
+            "semantic": semantic_cache.get_stats(),
+            "index_version": search_engine.index_version
+        }
     }
 
+@app.get("/ready")
+async def readiness_check():
+    """200 once both models and every domain have loaded, 503 (with progress) until then"""
+    ready = all(status == "ready" for status in startup_status.values())
+    return JSONResponse(
+        status_code=200 if ready else 503,
+        content={
+            "ready": ready,
+            "ready_domains": [name for name in DOMAINS if is_ready(f"domain:{name}")],
+            "components": dict(startup_status)
+        }
+    )
+
+def route_query(query, query_embedding):
+    """Classify a query into a domain (cheap once the embedding is known)"""
+    classification = classifier.classify_query(query, query_embedding=query_embedding)
+    domain = classification["domain"]
+    confidence = classification["confidence"]
+    print(f"Query classified as '{domain}' with confidence {confidence}")
+    
+    # Verify query classification makes sense
+    domain = force_general_domain(query, domain)
+    
+    return domain, confidence
+
+async def embed_query(query):
+    """Query embedding from the cache, or from the micro-batcher on a miss"""
+    query_embedding = embedding_cache.get(query)
+    if query_embedding is None:
+        query_embedding = await query_batcher.embed(query)
+        embedding_cache.put(query, query_embedding)
+    return query_embedding
+
+def response_cache_key(query, domain, max_length):
+    return (normalize_query(query), domain, max_length, search_engine.index_version)
+
+def get_cached_response(query, domain, query_embedding, max_length):
+    """Exact-match cached response, else one cached for a paraphrase, else None"""
+    cached_response = response_cache.get(response_cache_key(query, domain, max_length))
+    if cached_response is None:
+        # Responses generated with a different length limit are not interchangeable
+        cached_response = semantic_cache.get((domain, max_length), query_embedding, search_engine.index_version)
+    return cached_response
+
+def cache_response(query, domain, query_embedding, max_length, result):
+    response_cache.put(response_cache_key(query, domain, max_length), result)
+    semantic_cache.put((domain, max_length), query_embedding, result, search_engine.index_version)
+
+def retrieve_documents(query, domain, query_embedding, timer=None):
+    """Retrieve a query's supporting documents, falling back to general (blocking)"""
+    timer = timer or RequestTimer(stage_seconds, endpoint="internal")
+    
+    # Retrieve relevant documents
+    with timer.span("search", domain=domain):
+        relevant_docs = search_engine.search(
+            query, 
+            domain=domain,
+            top_k=5,
+            query_embedding=query_embedding
+        )
+    
+    # Check if we have meaningful results
+    used_general_fallback = needs_general_fallback(domain, relevant_docs)
+    if used_general_fallback:
+        # For specialized domains with no good matches, try general domain
+        print(f"No good matches in {domain}, trying general domain")
+        with timer.span("fallback", domain="general"):
+            general_docs = search_engine.search(
+                query, domain="general", top_k=3, query_embedding=query_embedding
+            )
+        
+        # Combine results
+        relevant_docs = general_docs + relevant_docs
+    
+    timer.path = retrieval_path(domain, relevant_docs, used_general_fallback)
+    return relevant_docs
+
+def retrieve_with_prompt(query, domain, query_embedding, timer):
+    """Retrieve documents and build the generator prompt from them in the same worker (blocking)"""
+    relevant_docs = retrieve_documents(query, domain, query_embedding, timer)
+    with timer.span("prompt", domain=domain):
+        input_ids = text_generator.build_input_ids(query, relevant_docs, domain)
+    return relevant_docs, input_ids
+
+def retrieve_batch_with_prompts(queries, domains, query_embeddings):
+    """Documents and generator prompts for a batch of routed queries (blocking)"""
+    docs = batch_pipeline.retrieve(queries, domains, query_embeddings)
+    prompts = [
+        text_generator.build_input_ids(query, context_docs, domain)
+        for query, context_docs, domain in zip(queries, docs, domains)
+    ]
+    return docs, prompts
+
+def finish_request(timer, domain, request, result):
+    """Record a completed request's metrics, attaching its timing breakdown if requested"""
+    request_seconds.observe(timer.elapsed(), **timer.labels)
+    requests_total.inc(domain=domain, path=timer.path, **timer.labels)
+    if request.include_timings:
+        return {**result, "timings": timer.breakdown()}
+    return result
+
 @app.post("/query", response_model=QueryResponse)
 async def process_query(request: QueryRequest):
+    timer = RequestTimer(stage_seconds, endpoint="query")
     try:
         # 1. Log the incoming query for debugging
         print(f"Processing query: {request.query}")
+        require_ready("embedding_model")
         
-        # 2. Classify the query
-        classification = classifier.classify_query(request.query)
-        domain = classification["domain"]
-        confidence = classification["confidence"]
-        print(f"Query classified as '{domain}' with confidence {confidence}")
+        # 2. Embed the query once and share it across classification and search
+        with timer.span("embed"):
+            query_embedding = await embed_query(request.query)
         
-        # 3. Verify query classification makes sense
-        if "artificial intelligence" in request.query.lower() or "ai" in request.query.lower().split():
-            print("Query contains AI terminology, forcing general domain")
-            domain = "general"
-            
-        # 4. Retrieve relevant documents
-        relevant_docs = search_engine.search(
-            request.query, 
-            domain=domain,
-            top_k=5
-        )
+        # 3. Classify the query
+        with timer.span("classify"):
+            domain, confidence = route_query(request.query, query_embedding)
         
-        # 5. Check if we have meaningful results
-        has_relevant_docs = any(doc.get("score", 0) > 0.4 for doc in relevant_docs)
+        # 4. Serve repeated (or paraphrased) questions from the response caches
+        with timer.span("cache_lookup"):
+            cached_response = None if request.bypass_cache else get_cached_response(
+                request.query, domain, query_embedding, request.max_length or 256
+            )
+        if cached_response is not None:
+            timer.path = "cache"
+            return finish_request(timer, domain, request, cached_response)
         
-        # 6. Generate appropriate response
-        if domain != "general" and not has_relevant_docs:
-            # For specialized domains with no good matches, try general domain
-            print(f"No good matches in {domain}, trying general domain")
-            general_docs = search_engine.search(request.query, domain="general", top_k=3)
-            
-            # Combine results
-            relevant_docs = general_docs + relevant_docs
-        
-        # 7. Generate response with domain context
-        text_response = text_generator.generate_response(
-            request.query,
-            relevant_docs,
-            domain=domain
+        # Domains that are still ingesting cannot answer yet; loaded ones already can
+        require_ready(f"domain:{domain}", "text_generator")
+        
+        # 5. Retrieve relevant documents
+        relevant_docs, input_ids = await inference_executor.run(
+            "retrieve", retrieve_with_prompt, request.query, domain, query_embedding, timer
         )
         
-        # 8. Return results
-        return {
-            "response": text_response["response"],
-            "sources": relevant_docs,
-            "domain": domain,
-            "confidence": float(confidence)
-        }
+        # 6. Generate response with domain context
+        with timer.span("generate", domain=domain):
+            text_response = await generation_scheduler.generate(
+                request.query,
+                relevant_docs,
+                domain=domain,
+                max_length=request.max_length or 256,
+                input_ids=input_ids
+            )
         
+        # 7. Cache and return results
+        with timer.span("serialize"):
+            result = {
+                "response": text_response["response"],
+                "sources": relevant_docs,
+                "domain": domain,
+                "confidence": float(confidence)
+            }
+            if not request.bypass_cache:
+                cache_response(request.query, domain, query_embedding, request.max_length or 256, result)
+        return finish_request(timer, domain, request, result)
+        
+    except HTTPException as e:
+        errors_total.inc(endpoint="query", status=str(e.status_code))
+        raise
+    except StageOverloadedError as e:
+        print(f"Rejecting query: {str(e)}")
+        errors_total.inc(endpoint="query", status="503")
+        raise HTTPException(status_code=503, detail=str(e))
+    except StageTimeoutError as e:
+        print(f"Query timed out: {str(e)}")
+        errors_total.inc(endpoint="query", status="504")
+        raise HTTPException(status_code=504, detail=str(e))
     except Exception as e:
         print(f"Error processing query: {str(e)}")
+        errors_total.inc(endpoint="query", status="500")
         raise HTTPException(status_code=500, detail=str(e))
 
+def sse_event(event, data):
+    """Format one server-sent event"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@app.post("/query/stream")
+async def process_query_stream(request: QueryRequest):
+    """
+    Stream a query's answer as server-sent events
+    
+    Emits a "meta" event with the domain, confidence and sources as soon as
+    retrieval finishes, then "token" events as the answer is generated, then
+    "done" with the full response (or "error").
+    """
+    timer = RequestTimer(stage_seconds, endpoint="stream")
+    try:
+        print(f"Processing streaming query: {request.query}")
+        require_ready("embedding_model")
+        with timer.span("embed"):
+            query_embedding = await embed_query(request.query)
+        with timer.span("classify"):
+            domain, confidence = route_query(request.query, query_embedding)
+        
+        with timer.span("cache_lookup"):
+            cached_response = None if request.bypass_cache else get_cached_response(
+                request.query, domain, query_embedding, request.max_length or 256
+            )
+        if cached_response is None:
+            require_ready(f"domain:{domain}", "text_generator")
+            # The prompt is built in the retrieve worker, off the event loop
+            relevant_docs, input_ids = await inference_executor.run(
+                "retrieve", retrieve_with_prompt, request.query, domain, query_embedding, timer
+            )
+    except HTTPException as e:
+        errors_total.inc(endpoint="stream", status=str(e.status_code))
+        raise
+    except StageOverloadedError as e:
+        errors_total.inc(endpoint="stream", status="503")
+        raise HTTPException(status_code=503, detail=str(e))
+    except StageTimeoutError as e:
+        errors_total.inc(endpoint="stream", status="504")
+        raise HTTPException(status_code=504, detail=str(e))
+    except Exception as e:
+        print(f"Error processing query: {str(e)}")
+        errors_total.inc(endpoint="stream", status="500")
+        raise HTTPException(status_code=500, detail=str(e))
+    
+    async def events():
+        if cached_response is not None:
+            timer.path = "cache"
+            yield sse_event("meta", {key: cached_response[key] for key in ("domain", "confidence", "sources")})
+            yield sse_event("token", {"text": cached_response["response"]})
+            yield sse_event("done", finish_request(timer, domain, request, cached_response))
+            return
+        
+        yield sse_event("meta", {"domain": domain, "confidence": float(confidence), "sources": relevant_docs})
+        
+        generate_start = timer.elapsed()
+        streamer, generate = text_generator.prepare_stream(
+            request.query, relevant_docs, domain=domain,
+            max_length=request.max_length or 256, input_ids=input_ids
+        )
+        if streamer is None:
+            pieces = [NO_CONTEXT_RESPONSE]
+            yield sse_event("token", {"text": NO_CONTEXT_RESPONSE})
+        else:
+            # Generation runs on the bounded generate pool; tokens are read off its streamer
+            generation = asyncio.ensure_future(inference_executor.run("generate", generate))
+            await asyncio.sleep(0)
+            if generation.done() and generation.exception():
+                errors_total.inc(endpoint="stream", status="stream")
+                yield sse_event("error", {"detail": str(generation.exception())})
+                return
+            
+            pieces = []
+            try:
+                async for text in iterate_in_threadpool(iter(streamer)):
+                    if text:
+                        pieces.append(text)
+                        yield sse_event("token", {"text": text})
+                await generation
+            except Exception as e:
+                print(f"Error streaming response: {str(e)}")
+                errors_total.inc(endpoint="stream", status="stream")
+                yield sse_event("error", {"detail": str(e)})
+                return
+        timer.record("generate", timer.elapsed() - generate_start, domain)
+        
+        with timer.span("serialize"):
+            result = {
+                "response": "".join(pieces),
+                "sources": relevant_docs,
+                "domain": domain,
+                "confidence": float(confidence)
+            }
+            if not request.bypass_cache:
+                cache_response(request.query, domain, query_embedding, request.max_length or 256, result)
+        yield sse_event("done", finish_request(timer, domain, request, result))
+    
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+@app.post("/query/batch")
+async def process_query_batch(requests: List[QueryRequest]):
+    """
+    Answer a list of queries, streamed back as NDJSON
+    
+    Queries are processed in chunks: each chunk is embedded in one forward
+    pass, classified and retrieved with matrix operations, and generated
+    through the shared batching scheduler. Every line carries the request's
+    "index" and either its QueryResponse fields or an "error".
+    """
+    print(f"Processing batch of {len(requests)} queries")
+    require_ready("embedding_model", "text_generator", "batch_pipeline")
+    
+    async def answer_chunk(offset, chunk):
+        # Spans time whole chunks, under their own endpoint label
+        timer = RequestTimer(stage_seconds, endpoint="batch")
+        queries = [request.query for request in chunk]
+        with timer.span("embed"):
+            query_embeddings = await inference_executor.run("embed", batch_pipeline.embed, queries)
+        with timer.span("classify"):
+            routes = batch_pipeline.route(queries, query_embeddings)
+        
+        # Queries routed to a domain that is still ingesting get an error line
+        results = [None] * len(chunk)
+        answerable = []
+        for i, (domain, _) in enumerate(routes):
+            if is_ready(f"domain:{domain}"):
+                answerable.append(i)
+            else:
+                errors_total.inc(endpoint="batch", status="503")
+                results[i] = {"index": offset + i, "error": f"domain:{domain} is not ready"}
+        if not answerable:
+            return results
+        
+        queries = [queries[i] for i in answerable]
+        domains = [routes[i][0] for i in answerable]
+        with timer.span("search"):
+            docs, prompts = await inference_executor.run(
+                "retrieve", retrieve_batch_with_prompts, queries, domains,
+                np.asarray(query_embeddings)[answerable]
+            )
+        with timer.span("generate"):
+            pending = list(zip(answerable, queries, docs, domains, prompts))
+            responses = []
+            while pending:
+                # Never queue more than the scheduler has room for; the rest waits for the next group
+                free_slots = generation_scheduler.free_slots()
+                group_size = len(pending) if free_slots is None else max(free_slots, 1)
+                group, pending = pending[:group_size], pending[group_size:]
+                responses.extend(await asyncio.gather(*[
+                    generation_scheduler.generate(query, context_docs, domain=domain,
+                                                  max_length=chunk[i].max_length or 256, input_ids=input_ids)
+                    for i, query, context_docs, domain, input_ids in group
+                ], return_exceptions=True))
+        
+        for i, response, context_docs in zip(answerable, responses, docs):
+            domain, confidence = routes[i]
+            if isinstance(response, Exception):
+                # One failed request does not take the rest of the chunk with it
+                status = ("503" if isinstance(response, StageOverloadedError)
+                          else "504" if isinstance(response, StageTimeoutError) else "500")
+                errors_total.inc(endpoint="batch", status=status)
+                results[i] = {"index": offset + i, "error": str(response)}
+                continue
+            requests_total.inc(endpoint="batch", domain=domain, path="batch")
+            result = {"index": offset + i, "response": response["response"], "sources": context_docs,
+                      "domain": domain, "confidence": confidence}
+            if chunk[i].include_timings:
+                result["timings"] = timer.breakdown()
+            results[i] = result
+        return results
+    
+    async def lines():
+        for offset in range(0, len(requests), batch_pipeline.chunk_size):
+            chunk = requests[offset:offset + batch_pipeline.chunk_size]
+            try:
+                results = await answer_chunk(offset, chunk)
+            except Exception as e:
+                print(f"Error processing query batch: {str(e)}")
+                errors_total.inc(len(chunk), endpoint="batch", status="chunk")
+                results = [{"index": offset + i, "error": str(e)} for i in range(len(chunk))]
+            for result in results:
+                yield json.dumps(result) + "\n"
+    
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+def require_domain(domain):
+    if domain not in DOMAINS:
+        raise HTTPException(status_code=404, detail=f"Unknown domain: {domain}")
+
+@app.post("/ingest", status_code=202)
+async def ingest_documents(request: IngestRequest):
+    """Queue (re-)ingestion of a domain's PDFs into a new store version, swapped in when built"""
+    require_domain(request.domain)
+    require_ready("embedding_model", f"domain:{request.domain}")
+    
+    for pdf_file in request.pdf_files:
+        if os.path.basename(pdf_file) != pdf_file or not pdf_file.lower().endswith(".pdf"):
+            raise HTTPException(status_code=400, detail=f"Invalid PDF file name: {pdf_file}")
+        if not os.path.isfile(os.path.join(data_dir, pdf_file)):
+            raise HTTPException(status_code=400, detail=f"{pdf_file} not found in the data directory")
+    
+    if request.replace:
+        pdf_files = list(dict.fromkeys(request.pdf_files))
+    else:
+        # Re-processing the live files picks up PDFs that changed on disk
+        pdf_files = list(dict.fromkeys(domain_pdf_files(request.domain) + request.pdf_files))
+    
+    return ingestion_queue.submit(
+        "ingest", request.domain, build_domain_version, request.domain, pdf_files,
+        pdf_files=pdf_files, replace=request.replace
+    )
+
+@app.get("/ingest/jobs")
+async def list_ingestion_jobs(domain: Optional[str] = None):
+    return {"jobs": ingestion_queue.list(domain)}
+
+@app.get("/ingest/jobs/{job_id}")
+async def get_ingestion_job(job_id: str):
+    job = ingestion_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Unknown job: {job_id}")
+    return job
+
+@app.get("/domains/{domain}/versions")
+async def list_store_versions(domain: str):
+    """Published store versions of a domain and the one being served"""
+    require_domain(domain)
+    return {
+        "domain": domain,
+        "current": store_versions.current_version(domain),
+        "versions": store_versions.versions(domain)
+    }
+
+@app.post("/domains/{domain}/rollback", status_code=202)
+async def rollback_domain(domain: str, request: RollbackRequest):
+    """Queue a swap back to an earlier store version (by default the one before the live one)"""
+    require_domain(domain)
+    require_ready("embedding_model", f"domain:{domain}")
+    
+    version = request.version if request.version is not None else store_versions.previous_version(domain)
+    if version is None or store_versions.manifest(domain, version) is None:
+        raise HTTPException(status_code=404, detail=f"No store version to roll back to for {domain}")
+    
+    return ingestion_queue.submit("rollback", domain, activate_version, domain, version, version=version)
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    """Prometheus text-format metrics"""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
\ No newline at end of file
@@ -0,0 +1,182 @@
+import argparse
+import json
+import os
+import time
+import faiss
+import numpy as np
+
+INDEX_KINDS = ("flat", "ivf", "hnsw")
+
+class FaissIndex:
+    """Approximate nearest-neighbour index over a domain's normalized embedding matrix"""
+
+    def __init__(self, index, kind, nprobe=8, ef_search=64):
+        """
+        Args:
+            index: A built faiss index using inner-product similarity
+            kind: "flat", "ivf" or "hnsw"
+            nprobe: IVF lists probed per query (higher = better recall, slower)
+            ef_search: HNSW candidate list size per query (higher = better recall, slower)
+        """
+        self.index = index
+        self.kind = kind
+        self.set_search_params(nprobe=nprobe, ef_search=ef_search)
+
+    def __len__(self):
+        return self.index.ntotal
+
+    @classmethod
+    def build(cls, embeddings, kind="flat", nlist=256, hnsw_m=32, ef_construction=200, **search_params):
+        """
+        Build an index over an (n, dim) matrix of L2-normalized embeddings
+
+        Args:
+            embeddings: Embedding matrix
+            kind: "flat" (exact), "ivf" or "hnsw"
+            nlist: Number of IVF clusters (capped so each cluster has enough training points)
+            hnsw_m: HNSW graph degree
+            ef_construction: HNSW build-time candidate list size
+        """
+        if kind not in INDEX_KINDS:
+            raise ValueError(f"Unknown index kind: {kind}")
+
+        matrix = np.ascontiguousarray(embeddings, dtype=np.float32)
+        dim = matrix.shape[1]
+
+        if kind == "flat":
+            index = faiss.IndexFlatIP(dim)
+        elif kind == "ivf":
+            # faiss wants roughly 39 training points per cluster
+            nlist = max(1, min(nlist, len(matrix) // 39))
+            quantizer = faiss.IndexFlatIP(dim)
+            index = faiss.IndexIVFFlat(quantizer, dim, nlist, faiss.METRIC_INNER_PRODUCT)
+            index.train(matrix)
+        else:
+            index = faiss.IndexHNSWFlat(dim, hnsw_m, faiss.METRIC_INNER_PRODUCT)
+            index.hnsw.efConstruction = ef_construction
+
+        index.add(matrix)
+        return cls(index, kind, **search_params)
+
+    @classmethod
+    def load_or_build(cls, embeddings, kind="flat", store_path=None, build_params=None, **search_params):
+        """
+        Load the persisted index next to a vector store, or build (and persist) it
+
+        A persisted index is rebuilt if its size no longer matches the store.
+        """
+        build_params = build_params or {}
+        index_path = os.path.join(store_path, f"faiss_{kind}.index") if store_path else None
+
+        if index_path and os.path.exists(index_path):
+            index = faiss.read_index(index_path)
+            if index.ntotal == len(embeddings):
+                return cls(index, kind, **search_params)
+            print(f"Stale {kind} index at {index_path}, rebuilding")
+
+        start_time = time.time()
+        ann = cls.build(embeddings, kind=kind, **build_params, **search_params)
+        print(f"Built {kind} index over {len(embeddings)} vectors in {time.time() - start_time:.2f} seconds")
+
+        if index_path:
+            ann.save(index_path)
+        return ann
+
+    def save(self, index_path):
+        tmp_path = f"{index_path}.tmp"
+        faiss.write_index(self.index, tmp_path)
+        os.replace(tmp_path, index_path)
+
+    def set_search_params(self, nprobe=None, ef_search=None):
+        """Adjust the recall/latency trade-off without rebuilding"""
+        if self.kind == "ivf" and nprobe is not None:
+            faiss.ParameterSpace().set_index_parameter(self.index, "nprobe", nprobe)
+        if self.kind == "hnsw" and ef_search is not None:
+            faiss.ParameterSpace().set_index_parameter(self.index, "efSearch", ef_search)
+
+    def search(self, query_embeddings, k):
+        """
+        Top-k inner-product search
+
+        Args:
+            query_embeddings: A single embedding or an (n, dim) matrix of embeddings
+            k: Neighbours per query
+
+        Returns:
+            (scores, ids) arrays of shape (n, k); missing neighbours have id -1
+        """
+        queries = np.ascontiguousarray(np.atleast_2d(query_embeddings), dtype=np.float32)
+        queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+        return self.index.search(queries, min(k, len(self)))
+
+def recall_report(exact_engine, ann_engine, query_texts, query_embeddings, domain, k=10):
+    """
+    Compare the fused (cosine + BM25) ranking an ANN-backed SearchEngine serves with exact search
+
+    Args:
+        exact_engine: SearchEngine using the "exact" backend
+        ann_engine: SearchEngine over the same collection using an ANN backend
+        query_texts: Query strings (their key terms drive the keyword part of the score)
+        query_embeddings: (n, dim) query embeddings
+        domain: Collection to search
+        k: Results compared per query
+
+    Returns:
+        Dict with recall@k of the served results and mean/p95 per-query latency for both paths
+    """
+    def run(engine):
+        found, latencies = [], []
+        for text, embedding in zip(query_texts, query_embeddings):
+            start = time.perf_counter()
+            hits = engine.search(text, domain=domain, top_k=k, query_embedding=embedding)
+            latencies.append((time.perf_counter() - start) * 1000)
+            found.append({(hit["metadata"].get("source"), hit["metadata"].get("chunk_id"), hit["content"])
+                          for hit in hits if hit["domain"] == domain})
+        return found, latencies
+
+    exact_ids, exact_latencies = run(exact_engine)
+    ann_ids, ann_latencies = run(ann_engine)
+    hits = sum(len(expected & found) for expected, found in zip(exact_ids, ann_ids))
+
+    return {
+        "kind": ann_engine.index_backend,
+        "k": k,
+        "queries": len(query_texts),
+        "recall_at_k": round(hits / max(1, sum(len(ids) for ids in exact_ids)), 4),
+        "exact_ms_mean": round(float(np.mean(exact_latencies)), 4),
+        "exact_ms_p95": round(float(np.percentile(exact_latencies, 95)), 4),
+        "ann_ms_mean": round(float(np.mean(ann_latencies)), 4),
+        "ann_ms_p95": round(float(np.percentile(ann_latencies, 95)), 4)
+    }
+
+if __name__ == "__main__":
+    # Example: python -m utils.ann_index vector_db/clinical_ctg-studies.pdf.store --kind ivf --nprobe 1 4 16
+    from .search_engine import SearchEngine
+    from .vector_store import load_vector_store
+
+    parser = argparse.ArgumentParser(description="Recall vs latency of FAISS-backed search against exact search")
+    parser.add_argument("store_path")
+    parser.add_argument("--kind", choices=("ivf", "hnsw"), default="ivf")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 4, 8, 16, 32])
+    parser.add_argument("--ef-search", type=int, nargs="+", default=[16, 32, 64, 128])
+    args = parser.parse_args()
+
+    store = load_vector_store(args.store_path)
+    matrix = np.asarray(store.embeddings, dtype=np.float32)
+
+    # Perturbed corpus rows, with the opening words of their chunks as text, stand in for real queries
+    rng = np.random.default_rng(0)
+    rows = rng.choice(len(matrix), size=min(args.queries, len(matrix)), replace=False)
+    sample = matrix[rows] + rng.normal(scale=0.01, size=(len(rows), matrix.shape[1])).astype(np.float32)
+    texts = [" ".join(store.contents[i].split()[:6]) for i in rows]
+
+    exact_engine = SearchEngine({"store": store})
+    ann_engine = SearchEngine({"store": store}, index_backend=args.kind)
+    settings = {"ivf": [{"nprobe": n} for n in args.nprobe],
+                "hnsw": [{"ef_search": ef} for ef in args.ef_search]}[args.kind]
+
+    for params in settings:
+        ann_engine.indexes["store"].ann.set_search_params(**params)
+        print(json.dumps({**params, **recall_report(exact_engine, ann_engine, texts, sample, "store", k=args.k)}))
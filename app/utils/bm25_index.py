@@ -0,0 +1,125 @@
+import os
+import re
+from collections import Counter
+import numpy as np
+
+BM25_FILE = "bm25.npz"
+
+STOP_WORDS = {'the', 'is', 'and', 'of', 'to', 'a', 'in', 'that', 'for'}
+
+_TOKEN_PATTERN = re.compile(r"\w+")
+
+def tokenize(text):
+    """Lowercased word tokens without stop words (shared by indexing and queries)"""
+    return [token for token in _TOKEN_PATTERN.findall(text.lower()) if token not in STOP_WORDS]
+
+class BM25Index:
+    """
+    Tokenized inverted index with precomputed BM25 term weights
+
+    Each posting stores its document id and its length-normalized term
+    frequency weight, so scoring a query only touches the posting lists of
+    its own terms.
+    """
+
+    def __init__(self, terms, offsets, doc_ids, weights, doc_freqs, n_docs, k1=1.5, b=0.75):
+        self.terms = terms
+        self.vocabulary = {term: i for i, term in enumerate(terms)}
+        self.offsets = offsets
+        self.doc_ids = doc_ids
+        self.weights = weights
+        self.doc_freqs = doc_freqs
+        self.n_docs = n_docs
+        self.k1 = k1
+        self.b = b
+        self.idf = np.log(1 + (n_docs - doc_freqs + 0.5) / (doc_freqs + 0.5)).astype(np.float32)
+
+    def __len__(self):
+        return self.n_docs
+
+    @classmethod
+    def build(cls, contents, k1=1.5, b=0.75):
+        """Build the index over a list of chunk texts"""
+        counts = [Counter(tokenize(content)) for content in contents]
+        doc_lengths = np.array([sum(c.values()) for c in counts], dtype=np.float32)
+        avg_length = float(doc_lengths.mean()) if len(doc_lengths) and doc_lengths.mean() > 0 else 1.0
+
+        postings = {}
+        for doc_id, term_counts in enumerate(counts):
+            for term, tf in term_counts.items():
+                postings.setdefault(term, []).append((doc_id, tf))
+
+        terms = sorted(postings)
+        offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(postings[term]) for term in terms])
+        doc_ids = np.empty(int(offsets[-1]), dtype=np.int32)
+        tfs = np.empty(int(offsets[-1]), dtype=np.float32)
+        for i, term in enumerate(terms):
+            ids, freqs = zip(*postings[term])
+            doc_ids[offsets[i]:offsets[i + 1]] = ids
+            tfs[offsets[i]:offsets[i + 1]] = freqs
+
+        # BM25 term-frequency saturation with document length normalization
+        norms = k1 * (1 - b + b * doc_lengths[doc_ids] / avg_length) if len(doc_ids) else tfs
+        weights = (tfs * (k1 + 1) / (tfs + norms)).astype(np.float32)
+        doc_freqs = np.diff(offsets).astype(np.float32)
+
+        return cls(terms, offsets, doc_ids, weights, doc_freqs, len(contents), k1=k1, b=b)
+
+    def score(self, query_terms, normalize=True):
+        """
+        BM25 score of every document for a set of query terms
+
+        Args:
+            query_terms: Iterable of (already tokenized) query terms
+            normalize: Scale into [0, 1) by the best score any document could
+                       reach for these terms, so it can be fused with cosine similarity
+        """
+        scores = np.zeros(self.n_docs, dtype=np.float32)
+        upper_bound = 0.0
+
+        for term in set(query_terms):
+            i = self.vocabulary.get(term)
+            if i is None:
+                continue
+            start, end = self.offsets[i], self.offsets[i + 1]
+            scores[self.doc_ids[start:end]] += self.idf[i] * self.weights[start:end]
+            upper_bound += self.idf[i] * (self.k1 + 1)
+
+        if normalize and upper_bound > 0:
+            scores /= upper_bound
+        return scores
+
+    def save(self, store_path):
+        """Persist the index inside a vector store directory"""
+        tmp_path = os.path.join(store_path, f"{BM25_FILE}.tmp.npz")
+        np.savez(
+            tmp_path,
+            terms=np.array(self.terms, dtype=str),
+            offsets=self.offsets,
+            doc_ids=self.doc_ids,
+            weights=self.weights,
+            doc_freqs=self.doc_freqs,
+            params=np.array([self.n_docs, self.k1, self.b], dtype=np.float64)
+        )
+        os.replace(tmp_path, os.path.join(store_path, BM25_FILE))
+
+    @classmethod
+    def load(cls, store_path):
+        """Load the index persisted in a vector store directory, or None"""
+        path = os.path.join(store_path, BM25_FILE)
+        if not os.path.exists(path):
+            return None
+
+        with np.load(path) as data:
+            n_docs, k1, b = data["params"]
+            return cls(
+                data["terms"].tolist(),
+                data["offsets"],
+                data["doc_ids"],
+                data["weights"],
+                data["doc_freqs"],
+                int(n_docs),
+                k1=float(k1),
+                b=float(b)
+            )
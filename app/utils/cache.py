@@ -0,0 +1,247 @@
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+import numpy as np
+
+def normalize_query(query):
+    """Canonical form of a query for cache keys: lowercase, collapsed whitespace, no trailing punctuation"""
+    return re.sub(r"\s+", " ", query.lower()).strip().rstrip("?!. ")
+
+class LRUCache:
+    """Thread-safe bounded LRU cache with an optional per-entry TTL"""
+
+    def __init__(self, max_size=1024, ttl=None):
+        """
+        Args:
+            max_size: Maximum number of entries kept
+            ttl: Seconds an entry stays valid; None keeps entries until evicted
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Return the cached value, or None on a miss or expired entry"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, stored_at = entry
+                if self.ttl is None or time.monotonic() - stored_at <= self.ttl:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get_stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0
+        }
+
+class QueryEmbeddingCache(LRUCache):
+    """LRU of normalized query -> query embedding"""
+
+    def get(self, query):
+        return super().get(normalize_query(query))
+
+    def put(self, query, embedding):
+        super().put(normalize_query(query), embedding)
+
+    def get_or_compute(self, query, compute):
+        """Return the cached embedding for a query, computing and caching it on a miss"""
+        embedding = self.get(query)
+        if embedding is None:
+            embedding = compute(query)
+            self.put(query, embedding)
+        return embedding
+
+    def get_or_compute_many(self, queries, compute_batch):
+        """
+        Embeddings for a list of queries, computing only the cache misses in one batch
+
+        Args:
+            queries: List of query strings
+            compute_batch: Callable mapping a list of queries to an (n, dim) array
+
+        Returns:
+            (len(queries), dim) array in query order
+        """
+        embeddings = [self.get(query) for query in queries]
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if missing:
+            computed = compute_batch([queries[i] for i in missing])
+            for i, embedding in zip(missing, computed):
+                self.put(queries[i], embedding)
+                embeddings[i] = embedding
+        return np.vstack(embeddings) if embeddings else np.zeros((0, 0), dtype=np.float32)
+
+class _EmbeddingRows:
+    """Growable matrix of one partition's cached query embeddings; freed rows are masked, not moved"""
+
+    def __init__(self, dim):
+        self.matrix = np.zeros((16, dim), dtype=np.float32)
+        self.entry_ids = np.full(16, -1, dtype=np.int64)  # -1 marks a free row
+        self.size = 0
+        self.live = 0
+
+    def append(self, entry_id, embedding):
+        if self.size == len(self.entry_ids):
+            # Double the capacity, so appends are amortized O(dim)
+            self.matrix = np.concatenate([self.matrix, np.zeros_like(self.matrix)])
+            self.entry_ids = np.concatenate([self.entry_ids, np.full(len(self.entry_ids), -1, dtype=np.int64)])
+        row = self.size
+        self.matrix[row] = embedding
+        self.entry_ids[row] = entry_id
+        self.size += 1
+        self.live += 1
+        return row
+
+    def remove(self, row):
+        self.entry_ids[row] = -1
+        self.live -= 1
+
+    def compact(self):
+        """Drop freed rows; returns {entry id: new row} for the rows that moved"""
+        keep = np.flatnonzero(self.entry_ids[:self.size] >= 0)
+        self.matrix[:len(keep)] = self.matrix[keep]
+        self.entry_ids[:len(keep)] = self.entry_ids[keep]
+        self.entry_ids[len(keep):self.size] = -1
+        self.size = len(keep)
+        return {int(entry_id): row for row, entry_id in enumerate(self.entry_ids[:self.size])}
+
+    def best(self, query):
+        """(entry id, similarity) of the most similar live row, or (None, None)"""
+        if not self.live:
+            return None, None
+        similarities = self.matrix[:self.size] @ query
+        similarities[self.entry_ids[:self.size] < 0] = -np.inf
+        row = int(np.argmax(similarities))
+        return int(self.entry_ids[row]), float(similarities[row])
+
+class SemanticResponseCache:
+    """
+    Response cache keyed by query meaning rather than query text
+
+    A lookup returns a stored response when a past query in the same domain
+    (and index version) has an embedding within the similarity threshold,
+    so paraphrased questions reuse an earlier answer. Embeddings are appended
+    to a per-domain matrix as they are stored, so a lookup is one
+    matrix-vector product with no re-stacking.
+
+    E5 cosine similarities cluster high (roughly 0.7-1.0 even for unrelated
+    questions), so the threshold is a precision knob: questions that differ
+    only in an entity ("side effects of drug X" vs "... drug Y") can score
+    above 0.95. Raise it (or disable the cache) where such mix-ups matter.
+    """
+
+    def __init__(self, max_size=2048, ttl=600, threshold=0.95):
+        """
+        Args:
+            max_size: Maximum number of stored responses across all domains
+            ttl: Seconds a response stays valid; None keeps it until evicted
+            threshold: Minimum cosine similarity between query embeddings for a hit
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.threshold = threshold
+        self._entries = OrderedDict()  # entry id -> [(domain, version), row, value, stored_at], LRU order
+        self._expiry = deque()  # (stored_at, entry id) in insertion order, for TTL expiry
+        self._rows = {}  # (domain, version) -> _EmbeddingRows
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, domain, query_embedding, version=0):
+        """Return the response of the most similar cached query, or None"""
+        query = np.asarray(query_embedding, dtype=np.float32).reshape(-1)
+        query = query / max(float(np.linalg.norm(query)), 1e-12)
+
+        with self._lock:
+            self._expire()
+            rows = self._rows.get((domain, version))
+            if rows is not None:
+                entry_id, similarity = rows.best(query)
+                if entry_id is not None and similarity >= self.threshold:
+                    self._entries.move_to_end(entry_id)
+                    self.hits += 1
+                    return self._entries[entry_id][2]
+            self.misses += 1
+            return None
+
+    def put(self, domain, query_embedding, value, version=0):
+        embedding = np.asarray(query_embedding, dtype=np.float32).reshape(-1)
+        embedding = embedding / max(float(np.linalg.norm(embedding)), 1e-12)
+
+        with self._lock:
+            key = (domain, version)
+            rows = self._rows.get(key)
+            if rows is None:
+                rows = self._rows[key] = _EmbeddingRows(len(embedding))
+            entry_id = self._next_id
+            self._next_id += 1
+            stored_at = time.monotonic()
+            self._entries[entry_id] = [key, rows.append(entry_id, embedding), value, stored_at]
+            while len(self._entries) > self.max_size:
+                self._remove(next(iter(self._entries)))
+
+            if self.ttl is not None:
+                self._expiry.append((stored_at, entry_id))
+                # Entries evicted for size leave stale expiry records; drop them before they pile up
+                if len(self._expiry) > 2 * self.max_size:
+                    self._expiry = deque(record for record in self._expiry if record[1] in self._entries)
+
+    def _remove(self, entry_id):
+        key, row = self._entries.pop(entry_id)[:2]
+        rows = self._rows[key]
+        rows.remove(row)
+        if not rows.live:
+            del self._rows[key]
+        elif rows.size - rows.live > max(rows.live, 64):
+            # Reclaim freed rows once they outnumber live ones (amortized)
+            for moved_id, new_row in rows.compact().items():
+                self._entries[moved_id][1] = new_row
+
+    def _expire(self):
+        """Evict entries older than the TTL, oldest first"""
+        if self.ttl is None:
+            return
+        now = time.monotonic()
+        while self._expiry and now - self._expiry[0][0] > self.ttl:
+            _, entry_id = self._expiry.popleft()
+            if entry_id in self._entries:
+                self._remove(entry_id)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get_stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "threshold": self.threshold,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0
+        }
@@ -0,0 +1,126 @@
+import threading
+from collections import OrderedDict
+from .ingestion_manifest import chunk_hash
+from .vector_store import save_token_column, load_token_column
+
+class ContextBuilder:
+    """
+    Assemble generator prompts directly as token ids within a token budget
+
+    Chunk token ids are computed once per chunk (and can be persisted with the
+    vector store), so building a prompt rarely re-tokenizes retrieved context.
+    Only the most recently used chunks are kept in memory.
+    """
+
+    def __init__(self, tokenizer, tokenizer_name, max_input_tokens=512, max_cached_chunks=20000):
+        """
+        Args:
+            tokenizer: Generator tokenizer
+            tokenizer_name: Name the persisted token ids are stored under
+            max_input_tokens: Encoder input budget, including the closing EOS token
+            max_cached_chunks: Chunks whose token ids are kept in memory (LRU)
+        """
+        self.tokenizer = tokenizer
+        self.tokenizer_name = tokenizer_name
+        self.max_input_tokens = max_input_tokens
+        self.max_cached_chunks = max_cached_chunks
+        self._chunk_tokens = OrderedDict()  # chunk hash -> token ids, LRU
+        self._text_tokens = OrderedDict()  # small LRU for query/template fragments
+        self._lock = threading.Lock()
+
+    def attach_store(self, store):
+        """
+        Load (or compute and persist) token ids for every chunk in a VectorStore
+
+        The persisted column covers the whole store; only as many chunks as the
+        cache has room for are kept in memory.
+        """
+        if not len(store):
+            return
+
+        token_lists = load_token_column(store.path, self.tokenizer_name) if store.path else None
+        if token_lists is None or len(token_lists) != len(store):
+            token_lists = self.tokenizer(list(store.contents), add_special_tokens=False).input_ids
+            if store.path:
+                save_token_column(store.path, self.tokenizer_name, token_lists)
+
+        with self._lock:
+            room = max(self.max_cached_chunks - len(self._chunk_tokens), 0)
+        for row in range(min(room, len(store))):
+            self._cache_chunk(chunk_hash(store.contents[row]), list(token_lists[row]))
+
+    def _cache_chunk(self, key, ids):
+        with self._lock:
+            self._chunk_tokens[key] = ids
+            self._chunk_tokens.move_to_end(key)
+            while len(self._chunk_tokens) > self.max_cached_chunks:
+                self._chunk_tokens.popitem(last=False)
+
+    def chunk_tokens(self, content):
+        """Token ids of a context chunk, tokenizing it only when not cached"""
+        key = chunk_hash(content)
+        with self._lock:
+            ids = self._chunk_tokens.get(key)
+            if ids is not None:
+                self._chunk_tokens.move_to_end(key)
+                return ids
+        ids = self.tokenizer(content, add_special_tokens=False).input_ids
+        self._cache_chunk(key, ids)
+        return ids
+
+    def text_tokens(self, text):
+        """Token ids of a short prompt fragment, with a small LRU"""
+        with self._lock:
+            ids = self._text_tokens.get(text)
+            if ids is not None:
+                self._text_tokens.move_to_end(text)
+                return ids
+        ids = self.tokenizer(text, add_special_tokens=False).input_ids
+        with self._lock:
+            self._text_tokens[text] = ids
+            while len(self._text_tokens) > 1024:
+                self._text_tokens.popitem(last=False)
+        return ids
+
+    def build(self, query, context_docs, max_docs=None):
+        """
+        Token ids for a RAG prompt, packing the highest-scoring chunks that fit
+
+        Chunks are taken in descending score order and skipped if they do not
+        fit in the remaining budget; if not even the best chunk fits, its head
+        is used instead of dropping all context.
+
+        Returns:
+            List of token ids ending in EOS
+        """
+        header = self.text_tokens(f"Based on this context, answer the question: {query}\n\nContext:")
+        separator = self.text_tokens("\n\n")
+        budget = self.max_input_tokens - len(header) - 1  # reserve the EOS token
+
+        docs = sorted((doc for doc in context_docs if doc.get("content")),
+                      key=lambda doc: doc.get("score", 0.0), reverse=True)
+        if max_docs is not None:
+            docs = docs[:max_docs]
+
+        body = []
+        for doc in docs:
+            label = self.text_tokens(f"Document {len(body) + 1}:")
+            piece = (separator if body else []) + label + self.chunk_tokens(doc["content"])
+            if len(piece) <= budget:
+                body.append(piece)
+                budget -= len(piece)
+            elif not body and budget > len(label):
+                body.append(piece[:budget])
+                budget = 0
+
+        ids = list(header)
+        for piece in body:
+            ids.extend(piece)
+        ids = ids[:self.max_input_tokens - 1]
+        ids.append(self.tokenizer.eos_token_id)
+        return ids
+
+    def build_plain(self, text):
+        """Token ids for a prompt without retrieved context"""
+        ids = self.text_tokens(text)[:self.max_input_tokens - 1]
+        return list(ids) + [self.tokenizer.eos_token_id]
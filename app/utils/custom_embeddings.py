@@ -1,20 +1,96 @@
+import argparse
+import inspect
+import io
+import json
+import os
+import threading
+import time
 import torch
 from transformers import AutoTokenizer, AutoModel
 import numpy as np
 
+DEFAULT_MODEL_NAME = "intfloat/e5-large-v2"
+
+# Inference backends: fp32 PyTorch, dynamically int8-quantized PyTorch, or ONNX Runtime
+BACKENDS = ("torch", "int8", "onnx")
+# Backends the API may serve with; onnx is only usable from the agreement check
+# below until its vectors have been verified against the fp32 store
+SERVING_BACKENDS = ("torch", "int8")
+ONNX_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "newwebco", "onnx")
+# Part of the cached graph's file name; bump when the export changes so stale graphs are not reused
+ONNX_EXPORT_VERSION = 3
+
+# Process-wide registry of loaded models, keyed by (model_name, device, backend)
+_model_registry = {}
+_registry_lock = threading.Lock()
+
+def get_embedding_model(model_name=DEFAULT_MODEL_NAME, device=None, backend="torch"):
+    """
+    Return the shared E5EmbeddingModel for a model name, device and backend,
+    loading it on first use so every component reuses a single copy
+    """
+    # Quantized and ONNX backends are CPU-only
+    device = device or ("cuda" if torch.cuda.is_available() and backend == "torch" else "cpu")
+    key = (model_name, device, backend)
+    
+    with _registry_lock:
+        if key not in _model_registry:
+            _model_registry[key] = E5EmbeddingModel(model_name=model_name, device=device, backend=backend)
+        return _model_registry[key]
+
+def get_model_memory_report():
+    """Report the resident parameter/buffer memory of every registered model, in MB"""
+    with _registry_lock:
+        models = dict(_model_registry)
+    
+    report = {}
+    for (model_name, device, backend), model in models.items():
+        report[f"{model_name}@{device}/{backend}"] = round(model.memory_bytes() / (1024 * 1024), 1)
+    return report
+
 class E5EmbeddingModel:
     """Embedding model using the E5 transformer model"""
     
-    def __init__(self):
-        """Initialize the E5 embedding model"""
+    def __init__(self, model_name=DEFAULT_MODEL_NAME, device=None, backend="torch", onnx_path=None):
+        """
+        Initialize the E5 embedding model
+        
+        Prefer get_embedding_model() over constructing this directly so the
+        weights are only loaded once per process.
+        
+        Args:
+            model_name: Hugging Face model id
+            device: "cpu" or "cuda"; int8 and onnx backends always run on CPU
+            backend: "torch" (fp32), "int8" (dynamic quantization of Linear layers)
+                     or "onnx" (ONNX Runtime session, exported on first use)
+            onnx_path: Where to cache the exported ONNX graph
+        """
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown embedding backend: {backend}")
+        
         try:
             # Load E5 model and tokenizer
-            self.model_name = "intfloat/e5-large-v2"
+            self.model_name = model_name
+            self.backend = backend
             self.tokenizer = AutoTokenizer.from_pretrained(self.model_name)
             self.model = AutoModel.from_pretrained(self.model_name)
-            self.device = "cuda" if torch.cuda.is_available() else "cpu"
+            self.device = "cpu" if backend != "torch" else (device or ("cuda" if torch.cuda.is_available() else "cpu"))
             self.model.to(self.device)
-            print(f"Loaded E5 embedding model: {self.model_name} on {self.device}")
+            self.model.eval()
+            self.session = None
+            self._memory_bytes = None
+            
+            if backend == "int8":
+                self.model = torch.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8)
+            elif backend == "onnx":
+                self._load_onnx_session(onnx_path)
+            
+            # Serializes tokenizer and forward passes across threads sharing this instance
+            self._lock = threading.Lock()
+            
+            # Throughput of the most recent get_embeddings_bulk call
+            self.last_bulk_stats = {}
+            print(f"Loaded E5 embedding model: {self.model_name} on {self.device} ({self.backend})")
         except Exception as e:
             print(f"Error loading E5 embedding model: {e}")
             raise
@@ -43,52 +119,243 @@ class E5EmbeddingModel:
         for i in range(0, len(processed_texts), batch_size):
             batch_texts = processed_texts[i:i+batch_size]
             
-            # Tokenize and generate embeddings
-            inputs = self.tokenizer(batch_texts, padding=True, truncation=True, 
-                                   return_tensors="pt", max_length=512)
-            inputs = {k: v.to(self.device) for k, v in inputs.items()}
+            with self._lock:
+                # Tokenize and generate embeddings
+                inputs = self.tokenizer(batch_texts, padding=True, truncation=True, 
+                                       return_tensors="pt", max_length=512)
+                embeddings_np = self._encode(inputs)
             
-            # Generate embeddings
-            with torch.no_grad():
-                outputs = self.model(**inputs)
-                
-            # Use mean pooling to get document embeddings
-            attention_mask = inputs['attention_mask']
-            embeddings = self._mean_pooling(outputs.last_hidden_state, attention_mask)
-            
-            # Normalize embeddings
-            embeddings = torch.nn.functional.normalize(embeddings, p=2, dim=1)
-            
-            # Convert to numpy and add to results
-            embeddings_np = embeddings.cpu().numpy()
+            # Add to results
             all_embeddings.extend(embeddings_np)
             
         return all_embeddings
+    
+    def get_embeddings_bulk(self, texts, max_tokens_per_batch=8192, max_batch_size=64):
+        """
+        Generate passage embeddings for many texts with length-bucketed batching
+        
+        Passages are tokenized once, sorted by token length and grouped so that
+        each padded batch stays within a token budget; similar lengths batch
+        together, so little compute is spent on padding. Results come back in
+        the original order, and throughput is recorded in self.last_bulk_stats.
+        
+        Args:
+            texts: List of strings to generate embeddings for
+            max_tokens_per_batch: Budget for batch_size x longest sequence in a batch
+            max_batch_size: Upper bound on passages per batch
+            
+        Returns:
+            List of embeddings (numpy arrays), in input order
+        """
+        if isinstance(texts, str):
+            texts = [texts]
+        if not texts:
+            return []
+        
+        start_time = time.perf_counter()
+        processed_texts = [f"passage: {text}" for text in texts]
+        
+        with self._lock:
+            encoded = self.tokenizer(processed_texts, truncation=True, max_length=512)
+        lengths = [len(ids) for ids in encoded["input_ids"]]
+        order = sorted(range(len(texts)), key=lambda i: lengths[i])
+        
+        # Greedily grow each batch while batch_size x longest length fits the budget
+        batches, current = [], []
+        for i in order:
+            if current and (len(current) >= max_batch_size
+                            or (len(current) + 1) * lengths[i] > max_tokens_per_batch):
+                batches.append(current)
+                current = []
+            current.append(i)
+        if current:
+            batches.append(current)
+        
+        all_embeddings = [None] * len(texts)
+        padded_tokens = 0
+        for batch in batches:
+            features = [{key: encoded[key][i] for key in encoded.keys()} for i in batch]
+            with self._lock:
+                inputs = self.tokenizer.pad(features, padding=True, return_tensors="pt")
+                embeddings_np = self._encode(inputs)
+            padded_tokens += inputs["input_ids"].numel()
+            for i, embedding in zip(batch, embeddings_np):
+                all_embeddings[i] = embedding
+        
+        elapsed = time.perf_counter() - start_time
+        total_tokens = sum(lengths)
+        self.last_bulk_stats = {
+            "passages": len(texts),
+            "batches": len(batches),
+            "tokens": total_tokens,
+            "padding_ratio": round(1 - total_tokens / padded_tokens, 4) if padded_tokens else 0.0,
+            "seconds": round(elapsed, 3),
+            "passages_per_s": round(len(texts) / elapsed, 2) if elapsed else 0.0,
+            "tokens_per_s": round(total_tokens / elapsed, 1) if elapsed else 0.0
+        }
+        return all_embeddings
 
     def get_query_embedding(self, query):
         """Generate embedding specifically for a query with proper prefixing"""
+        return self.get_query_embeddings([query])[0]  # Return as numpy array
+    
+    def get_query_embeddings(self, queries):
+        """
+        Generate query embeddings for several queries in one padded forward pass
+        
+        Args:
+            queries: List of query strings
+            
+        Returns:
+            numpy array of shape (len(queries), dim)
+        """
         # E5 models expect "query: " prefix for queries
-        prefixed_query = f"query: {query}"
+        prefixed_queries = [f"query: {query}" for query in queries]
+        
+        with self._lock:
+            # Tokenize
+            inputs = self.tokenizer(prefixed_queries, padding=True, truncation=True, 
+                                   return_tensors="pt", max_length=512)
+            return self._encode(inputs)
+    
+    def _load_onnx_session(self, onnx_path=None):
+        """Export the model to ONNX (once) and open an ONNX Runtime session on it"""
+        try:
+            import onnxruntime as ort
+        except ImportError:
+            raise ImportError("The onnx embedding backend requires onnxruntime (pip install onnxruntime)")
+        
+        self.onnx_path = onnx_path or os.path.join(ONNX_CACHE_DIR, f"{self.model_name.replace('/', '__')}.v{ONNX_EXPORT_VERSION}.onnx")
+        if not os.path.exists(self.onnx_path):
+            print(f"Exporting {self.model_name} to {self.onnx_path}...")
+            os.makedirs(os.path.dirname(self.onnx_path), exist_ok=True)
+            sample = self.tokenizer(["query: export"], return_tensors="pt")
+            # input_names are assigned to graph inputs by position, and the graph takes
+            # them in forward()'s order, not the tokenizer's (input_ids, token_type_ids, attention_mask)
+            input_names = [name for name in inspect.signature(self.model.forward).parameters if name in sample]
+            dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in input_names}
+            dynamic_axes["last_hidden_state"] = {0: "batch", 1: "sequence"}
+            tmp_path = f"{self.onnx_path}.tmp"
+            with torch.no_grad():
+                torch.onnx.export(
+                    self.model,
+                    (dict(sample),),
+                    tmp_path,
+                    input_names=input_names,
+                    output_names=["last_hidden_state"],
+                    dynamic_axes=dynamic_axes,
+                    opset_version=14
+                )
+            os.replace(tmp_path, self.onnx_path)
+        
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(self.onnx_path, options, providers=["CPUExecutionProvider"])
+        self._onnx_inputs = [node.name for node in self.session.get_inputs()]
+        
+        # The exported graph replaces the PyTorch weights
+        self.model = None
+    
+    def _encode(self, inputs):
+        """Forward pass, mean pooling and L2 normalization for a tokenized batch"""
+        if self.session is not None:
+            return self._encode_onnx(inputs)
         
-        # Tokenize
-        inputs = self.tokenizer(prefixed_query, padding=True, truncation=True, 
-                               return_tensors="pt", max_length=512)
         inputs = {k: v.to(self.device) for k, v in inputs.items()}
         
         # Generate embeddings
         with torch.no_grad():
             outputs = self.model(**inputs)
             
-        # Mean pooling
+        # Use mean pooling to get sentence embeddings
         attention_mask = inputs['attention_mask']
         embeddings = self._mean_pooling(outputs.last_hidden_state, attention_mask)
         
-        # Normalize
+        # Normalize embeddings
         embeddings = torch.nn.functional.normalize(embeddings, p=2, dim=1)
         
-        return embeddings.cpu().numpy()[0]  # Return as numpy array
+        # Convert to numpy
+        return embeddings.cpu().numpy()
+    
+    def _encode_onnx(self, inputs):
+        """ONNX Runtime equivalent of _encode"""
+        feeds = {name: inputs[name].cpu().numpy() for name in self._onnx_inputs}
+        token_embeddings = self.session.run(["last_hidden_state"], feeds)[0]
+        
+        mask = feeds["attention_mask"][..., None].astype(np.float32)
+        embeddings = (token_embeddings * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+        return embeddings / np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+    
+    def memory_bytes(self):
+        """Bytes held by the model's weights"""
+        if self._memory_bytes is None:
+            if self.session is not None:
+                self._memory_bytes = os.path.getsize(self.onnx_path)
+            elif self.backend == "int8":
+                # Packed quantized weights are not exposed as parameters; measure the serialized state
+                buffer = io.BytesIO()
+                torch.save(self.model.state_dict(), buffer)
+                self._memory_bytes = buffer.tell()
+            else:
+                tensors = list(self.model.parameters()) + list(self.model.buffers())
+                self._memory_bytes = sum(t.numel() * t.element_size() for t in tensors)
+        return self._memory_bytes
     
     def _mean_pooling(self, token_embeddings, attention_mask):
         """Mean pooling operation to get sentence embeddings"""
         input_mask_expanded = attention_mask.unsqueeze(-1).expand(token_embeddings.size()).float()
         return torch.sum(token_embeddings * input_mask_expanded, 1) / torch.clamp(input_mask_expanded.sum(1), min=1e-9)
+
+def check_backend_agreement(model, store, sample_size=200, seed=0):
+    """
+    Compare a model's passage embeddings with the fp32 vectors already in a store
+    
+    Args:
+        model: E5EmbeddingModel using the backend under test
+        store: VectorStore whose embeddings were produced by the fp32 model
+        sample_size: Number of stored chunks to re-embed
+        
+    Returns:
+        Dict of cosine agreement statistics and top-10 neighbour overlap
+    """
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(len(store), size=min(sample_size, len(store)), replace=False)
+    reference = np.asarray(store.embeddings, dtype=np.float32)
+    reference = reference / np.maximum(np.linalg.norm(reference, axis=1, keepdims=True), 1e-12)
+    
+    start_time = time.perf_counter()
+    candidate = np.vstack(model.get_embeddings_bulk([store.contents[i] for i in rows]))
+    elapsed = time.perf_counter() - start_time
+    
+    cosines = np.sum(candidate * reference[rows], axis=1)
+    
+    # Do the candidate vectors retrieve the same neighbours from the fp32 corpus?
+    k = min(10, len(store))
+    overlaps = []
+    for expected_query, candidate_query in zip(reference[rows], candidate):
+        expected = set(np.argpartition(-(reference @ expected_query), k - 1)[:k].tolist())
+        found = set(np.argpartition(-(reference @ candidate_query), k - 1)[:k].tolist())
+        overlaps.append(len(expected & found) / k)
+    
+    return {
+        "backend": model.backend,
+        "samples": len(rows),
+        "cosine_mean": round(float(cosines.mean()), 5),
+        "cosine_min": round(float(cosines.min()), 5),
+        "cosine_p5": round(float(np.percentile(cosines, 5)), 5),
+        "top10_overlap": round(float(np.mean(overlaps)), 4),
+        "passages_per_s": round(len(rows) / elapsed, 2) if elapsed else 0.0
+    }
+
+if __name__ == "__main__":
+    # Example: python -m utils.custom_embeddings vector_db/clinical_ctg-studies.pdf.store --backend int8
+    from .vector_store import load_vector_store
+    
+    parser = argparse.ArgumentParser(description="Check an embedding backend against the stored fp32 corpus")
+    parser.add_argument("store_path")
+    parser.add_argument("--backend", choices=BACKENDS, default="int8")
+    parser.add_argument("--samples", type=int, default=200)
+    args = parser.parse_args()
+    
+    candidate_model = E5EmbeddingModel(backend=args.backend)
+    print(json.dumps(check_backend_agreement(candidate_model, load_vector_store(args.store_path), args.samples)))
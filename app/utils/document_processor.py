@@ -3,106 +3,216 @@ import os
 import pickle
 import numpy as np
 import time
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from pypdf import PdfReader
 from tqdm import tqdm
-from .custom_embeddings import E5EmbeddingModel
+from .custom_embeddings import get_embedding_model
+from .vector_store import VectorStore, save_vector_store, load_vector_store, is_vector_store
+from .bm25_index import BM25Index
+from .pdf_extraction import extract_page_range
+from .ingestion_manifest import file_sha256, chunk_hash, build_manifest, is_current, reusable_rows
 
 class DocumentProcessor:
     """Process documents and create embeddings"""
     
-    def __init__(self):
-        self.embedding_model = E5EmbeddingModel()
+    def __init__(self, embedding_model=None, store_dtype="float32", lazy_texts=False):
+        self.embedding_model = embedding_model or get_embedding_model()
         self.chunk_size = 1000
         self.chunk_overlap = 200
+        # On-disk embedding precision; float16 halves store size and page-cache footprint
+        self.store_dtype = store_dtype
+        # Return stores whose chunk texts stay memory-mapped, decoded only when read
+        self.lazy_texts = lazy_texts
+        # Chunks accumulated before a bulk, length-bucketed embedding call
+        self.embedding_batch_size = 64
+        # Page extraction runs in a process pool, a few pages per task
+        self.extraction_workers = min(4, os.cpu_count() or 1)
+        self.pages_per_task = 8
         
+    @property
+    def chunker_settings(self):
+        """Chunking parameters recorded in the ingestion manifest"""
+        return {"chunk_size": self.chunk_size, "chunk_overlap": self.chunk_overlap}
+    
     def process_pdf(self, pdf_path, vector_db_path, domain_name=None):
-        """Process a PDF into chunks and generate embeddings with progress indicators"""
+        """
+        Process a PDF into chunks and generate embeddings with progress indicators
+        
+        Ingestion is incremental: if the store's manifest matches the PDF hash,
+        chunker settings and model, the store is loaded as-is; otherwise only
+        chunks whose content hash is not already in the store are embedded.
+        """
         start_time = time.time()
         pdf_name = os.path.basename(pdf_path)
+        model_name = self.embedding_model.model_name
+        embedding_backend = self.embedding_model.backend
+        pdf_sha256 = file_sha256(pdf_path)
+        
+        existing = (
+            load_vector_store(vector_db_path, lazy_texts=self.lazy_texts)
+            if is_vector_store(vector_db_path) else None
+        )
+        if existing is not None and is_current(existing.manifest, pdf_sha256, self.chunker_settings, model_name, embedding_backend):
+            print(f"✓ {pdf_name} is unchanged, reusing {os.path.basename(vector_db_path)}")
+            return existing
+        
         print(f"Starting processing of {pdf_name} for domain: {domain_name or 'unknown'}")
         
-        # Extract text from PDF with progress bar
-        extract_start = time.time()
-        print(f"[1/3] Extracting text from PDF...")
-        chunks = self._extract_chunks_from_pdf(pdf_path)
-        extract_time = time.time() - extract_start
-        print(f"[1/3] ✓ Text extraction complete: {len(chunks)} chunks created in {extract_time:.2f} seconds")
-        
-        # Calculate embeddings for all chunks with progress bar
-        embedding_start = time.time()
-        print(f"[2/3] Generating embeddings for {len(chunks)} chunks...")
-        embeddings = []
-        
-        # Process embeddings in batches with tqdm
-        for i in tqdm(range(0, len(chunks), 8), desc="Embedding Chunks"):
-            batch = chunks[i:i+8]
-            batch_embeddings = self.embedding_model.get_embeddings(batch)
-            embeddings.extend(batch_embeddings)
+        # Stream chunks out of the extraction pool and embed them as they arrive,
+        # so CPU-bound page extraction overlaps with embedding
+        stage_start = time.time()
+        print(f"[1/2] Extracting and embedding chunks...")
+        reusable = reusable_rows(existing.manifest if existing is not None else None, model_name, embedding_backend)
+        chunks, chunk_hashes, embeddings = [], [], []
+        pending = []  # indices of chunks waiting for an embedding batch
+        embedding_time = 0.0
+        embedded_tokens = 0
+        
+        def embed_pending():
+            nonlocal embedding_time, embedded_tokens
+            batch_start = time.time()
+            batch_embeddings = self.embedding_model.get_embeddings_bulk([chunks[j] for j in pending])
+            for j, embedding in zip(pending, batch_embeddings):
+                embeddings[j] = embedding
+            embedding_time += time.time() - batch_start
+            embedded_tokens += self.embedding_model.last_bulk_stats.get("tokens", 0)
+            pending.clear()
+        
+        for chunk in tqdm(self._iter_chunks_from_pdf(pdf_path), desc="Embedding Chunks"):
+            digest = chunk_hash(chunk)
+            chunks.append(chunk)
+            chunk_hashes.append(digest)
             
-        embedding_time = time.time() - embedding_start
-        print(f"[2/3] ✓ Embeddings generation complete in {embedding_time:.2f} seconds")
+            if digest in reusable:
+                # Reuse the vector of a chunk that is already embedded
+                embeddings.append(np.array(existing.embeddings[reusable[digest]], dtype=np.float32))
+            else:
+                embeddings.append(None)
+                pending.append(len(chunks) - 1)
+                if len(pending) >= self.embedding_batch_size:
+                    embed_pending()
+        
+        if pending:
+            embed_pending()
+        
+        extract_time = time.time() - stage_start - embedding_time
+        reused = sum(digest in reusable for digest in chunk_hashes)
+        print(f"[1/2] ✓ {len(chunks)} chunks ready ({len(chunks) - reused} embedded, {reused} reused) "
+              f"in {time.time() - stage_start:.2f} seconds")
         
         # Create document metadata
         save_start = time.time()
-        print(f"[3/3] Creating and saving document metadata...")
-        documents = []
-        
-        for i, (chunk, embedding) in enumerate(tqdm(zip(chunks, embeddings), total=len(chunks), desc="Creating Documents")):
-            documents.append({
-                "content": chunk,
-                "embedding": embedding,
-                "metadata": {
-                    "source": os.path.basename(pdf_path),
-                    "chunk_id": i,
-                    "domain": domain_name or "general"
-                }
-            })
-        
-        # Save to disk with progress indication
-        os.makedirs(os.path.dirname(vector_db_path), exist_ok=True)
-        print(f"Saving {len(documents)} documents to {os.path.basename(vector_db_path)}...")
-        with open(vector_db_path, 'wb') as f:
-            pickle.dump(documents, f)
+        print(f"[2/2] Creating and saving document metadata...")
+        metadatas = [
+            {
+                "source": os.path.basename(pdf_path),
+                "chunk_id": i,
+                "domain": domain_name or "general"
+            }
+            for i in range(len(chunks))
+        ]
+        
+        # Save to disk as a columnar, memory-mappable store
+        print(f"Saving {len(chunks)} documents to {os.path.basename(vector_db_path)}...")
+        manifest = build_manifest(pdf_sha256, self.chunker_settings, model_name, chunk_hashes, embedding_backend)
+        existing = None  # release the memory map before the store is replaced
+        save_vector_store(
+            vector_db_path, chunks, embeddings, metadatas,
+            dtype=self.store_dtype, manifest=manifest
+        )
+        BM25Index.build(chunks).save(vector_db_path)
+        documents = load_vector_store(vector_db_path, lazy_texts=self.lazy_texts)
             
         save_time = time.time() - save_start
         total_time = time.time() - start_time
         
-        print(f"[3/3] ✓ Document metadata saved in {save_time:.2f} seconds")
+        print(f"[2/2] ✓ Document metadata saved in {save_time:.2f} seconds")
         print(f"✓ PDF processing complete. Total time: {total_time:.2f} seconds")
-        print(f"  - Extraction: {extract_time:.2f}s ({extract_time/total_time*100:.1f}%)")
+        print(f"  - Extraction (waiting on pages): {extract_time:.2f}s ({extract_time/total_time*100:.1f}%)")
         print(f"  - Embedding: {embedding_time:.2f}s ({embedding_time/total_time*100:.1f}%)")
+        if embedding_time > 0:
+            embedded = len(chunks) - reused
+            print(f"    {embedded / embedding_time:.1f} passages/s, {embedded_tokens / embedding_time:.0f} tokens/s")
         print(f"  - Saving: {save_time:.2f}s ({save_time/total_time*100:.1f}%)")
             
         return documents
     
     def _extract_chunks_from_pdf(self, pdf_path):
-        """Extract text chunks from a PDF with progress indicators"""
-        # Open the PDF
-        reader = PdfReader(pdf_path)
-        total_pages = len(reader.pages)
-        text = ""
+        """Extract all text chunks from a PDF"""
+        return list(self._iter_chunks_from_pdf(pdf_path))
+    
+    def _iter_page_texts(self, pdf_path):
+        """
+        Yield page texts in order, extracting page ranges in a process pool
         
-        # Extract text with progress bar
+        At most a few ranges are in flight at once, so pages are not buffered
+        far ahead of the consumer.
+        """
+        total_pages = len(PdfReader(pdf_path).pages)
         print(f"  - Reading {total_pages} pages...")
-        for page in tqdm(reader.pages, desc="Extracting Pages", total=total_pages):
-            page_text = page.extract_text() or ""
-            text += page_text + "\n"
         
-        # Split into chunks with progress indication
-        chunk_start = time.time()
-        print(f"  - Splitting text into chunks...")
+        # Small PDFs are not worth the process start-up cost
+        if self.extraction_workers <= 1 or total_pages <= self.pages_per_task:
+            yield from extract_page_range(pdf_path, 0, total_pages)
+            return
         
-        # Split by paragraphs first for better semantic coherence
-        paragraphs = text.split("\n\n")
-        chunks = []
+        ranges = [(start, min(start + self.pages_per_task, total_pages))
+                  for start in range(0, total_pages, self.pages_per_task)]
+        max_in_flight = self.extraction_workers * 2
+        
+        # Spawned (not forked) workers: ingestion runs on startup and job threads
+        # while other threads in this process hold model locks
+        with ProcessPoolExecutor(max_workers=self.extraction_workers,
+                                 mp_context=multiprocessing.get_context("spawn")) as pool:
+            in_flight = deque()
+            for start, end in ranges:
+                in_flight.append(pool.submit(extract_page_range, pdf_path, start, end))
+                if len(in_flight) >= max_in_flight:
+                    yield from in_flight.popleft().result()
+            while in_flight:
+                yield from in_flight.popleft().result()
+    
+    def _iter_paragraphs(self, page_texts):
+        """
+        Yield paragraphs as soon as their closing boundary has been seen
+        
+        Produces exactly the paragraphs of "\n".join(pages).split("\n\n")
+        without ever holding the whole document text. The unfinished paragraph
+        is kept as a list of pieces, so a paragraph spanning many pages is only
+        joined once rather than re-copied on every page.
+        """
+        tail = []  # pieces of the paragraph still open at the end of the last page
+        for page_text in page_texts:
+            text = page_text + "\n"
+            # A separator can straddle the page boundary when the open paragraph ends in "\n"
+            if tail and tail[-1].endswith("\n") and text.startswith("\n"):
+                tail[-1] = tail[-1][:-1]
+                yield "".join(tail)
+                tail = []
+                text = text[1:]
+            parts = text.split("\n\n")
+            if len(parts) > 1:
+                tail.append(parts[0])
+                yield "".join(tail)
+                yield from parts[1:-1]
+                tail = []
+            if parts[-1]:
+                tail.append(parts[-1])
+        yield "".join(tail)
+    
+    def _iter_chunks_from_pdf(self, pdf_path):
+        """Yield text chunks from a PDF while its pages are still being extracted"""
         current_chunk = ""
         
-        for paragraph in tqdm(paragraphs, desc="Creating Chunks"):
+        # Split by paragraphs first for better semantic coherence
+        for paragraph in self._iter_paragraphs(self._iter_page_texts(pdf_path)):
             # If adding this paragraph would exceed chunk size
             if len(current_chunk) + len(paragraph) > self.chunk_size:
-                # Add current chunk if not empty
+                # Yield current chunk if not empty
                 if current_chunk:
-                    chunks.append(current_chunk.strip())
+                    yield current_chunk.strip()
                 # Start new chunk
                 current_chunk = paragraph
             else:
@@ -112,23 +222,54 @@ class DocumentProcessor:
                 else:
                     current_chunk = paragraph
         
-        # Add the last chunk if not empty
+        # Yield the last chunk if not empty
         if current_chunk.strip():
-            chunks.append(current_chunk.strip())
-        
-        print(f"  - ✓ Chunking complete: {len(chunks)} chunks created in {time.time() - chunk_start:.2f} seconds")
-        return chunks
+            yield current_chunk.strip()
         
     def load_vector_store(self, vector_db_path):
-        """Load embeddings from disk with progress indicator"""
+        """Open a columnar vector store with its embedding matrix memory-mapped"""
         start_time = time.time()
         print(f"Loading embeddings from {os.path.basename(vector_db_path)}...")
         
         if os.path.exists(vector_db_path):
-            with open(vector_db_path, 'rb') as f:
-                documents = pickle.load(f)
+            documents = load_vector_store(vector_db_path, lazy_texts=self.lazy_texts)
             print(f"✓ Loaded {len(documents)} documents in {time.time() - start_time:.2f} seconds")
             return documents
         
         print(f"× No embeddings found at {vector_db_path}")
-        return []
\ No newline at end of file
+        return VectorStore.from_documents([])
+    
+    def migrate_pickle_store(self, pickle_path, vector_db_path):
+        """
+        Convert a legacy pickle vector store into the columnar format
+        
+        Only unpickle files this application wrote itself; pickle can execute
+        arbitrary code on load.
+        """
+        print(f"Migrating {os.path.basename(pickle_path)} to {os.path.basename(vector_db_path)}...")
+        with open(pickle_path, 'rb') as f:
+            documents = VectorStore.from_documents(pickle.load(f))
+        
+        # Store rows normalized so the search index can use the mapped matrix directly
+        embeddings = documents.embeddings
+        if len(documents):
+            embeddings = embeddings / np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+        
+        # The source PDF hash is unknown, so the next ingestion re-chunks the
+        # PDF but reuses every vector whose chunk content is unchanged (pickle
+        # stores predate the other backends, so their vectors are fp32 torch)
+        manifest = build_manifest(
+            None,
+            self.chunker_settings,
+            self.embedding_model.model_name,
+            [chunk_hash(content) for content in documents.contents]
+        )
+        save_vector_store(
+            vector_db_path,
+            documents.contents,
+            embeddings,
+            documents.metadatas,
+            dtype=self.store_dtype,
+            manifest=manifest
+        )
+        return self.load_vector_store(vector_db_path)
@@ -1,13 +1,14 @@
-from .custom_embeddings import E5EmbeddingModel
+from .custom_embeddings import get_embedding_model
 import numpy as np
-from sklearn.metrics.pairwise import cosine_similarity
 
 class DomainClassifier:
     """Classify queries into domains using E5 embeddings"""
     
-    def __init__(self):
+    def __init__(self, embedding_model=None, embedding_cache=None):
         """Initialize with domain descriptions"""
-        self.embedding_model = E5EmbeddingModel()
+        self.embedding_model = embedding_model or get_embedding_model()
+        # Optional QueryEmbeddingCache consulted before embedding a query
+        self.embedding_cache = embedding_cache
         
         # Domain descriptions
         self.domains = {
@@ -18,14 +19,45 @@ class DomainClassifier:
             "general": "General knowledge, technology, science, history, culture, education, business, entertainment, sports, politics, news, information, arts, artificial intelligence, computers, internet"
         }
         
-        # Pre-compute domain embeddings
-        self.domain_embeddings = {}
-        for domain, description in self.domains.items():
-            # Use passage embedding for domains
-            self.domain_embeddings[domain] = self.embedding_model.get_embeddings(description)[0]
+        # Pre-compute domain embeddings (use passage embeddings for domains), in one batch
+        self.domain_names = list(self.domains)
+        self._set_centroids(self.embedding_model.get_embeddings(list(self.domains.values())))
     
-    def classify_query(self, query):
-        """Classify a query into a domain"""
+    def _set_centroids(self, embeddings):
+        """Stack one L2-normalized centroid row per domain, in domain_names order"""
+        matrix = np.asarray(embeddings, dtype=np.float32)
+        self.centroids = matrix / np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+        self.domain_embeddings = dict(zip(self.domain_names, self.centroids))
+    
+    def fit_centroids(self, domain_embeddings, block_size=4096):
+        """
+        Replace description prototypes with the mean of each domain's stored chunk embeddings
+        
+        Args:
+            domain_embeddings: Dict mapping domain names to an (n, dim) chunk embedding matrix,
+                               or a list of them; domains that are missing or empty keep their
+                               description prototype
+            block_size: Rows normalized at a time
+        """
+        centroids = self.centroids.copy()
+        for i, domain in enumerate(self.domain_names):
+            matrices = domain_embeddings.get(domain)
+            if matrices is None:
+                continue
+            matrices = [m for m in (matrices if isinstance(matrices, list) else [matrices]) if len(m)]
+            if not matrices:
+                continue
+            # Mean of normalized rows, in blocks so memory-mapped stores are never copied whole
+            total = np.zeros(matrices[0].shape[1], dtype=np.float64)
+            for matrix in matrices:
+                for start in range(0, len(matrix), block_size):
+                    block = np.asarray(matrix[start:start + block_size], dtype=np.float32)
+                    total += (block / np.maximum(np.linalg.norm(block, axis=1, keepdims=True), 1e-12)).sum(axis=0)
+            centroids[i] = total / sum(len(matrix) for matrix in matrices)
+        self._set_centroids(centroids)
+    
+    def _keyword_override(self, query):
+        """Route technology questions to general on explicit keywords, or None"""
         # Extract query terms for keyword matching
         query_lower = query.lower()
         
@@ -42,26 +74,86 @@ class DomainClassifier:
         # Apply strong keyword override for technology questions to ensure they go to general
         if tech_count > 0 and tech_count >= clinical_count and tech_count >= food_count:
             return {"domain": "general", "confidence": 0.95}
+        return None
+    
+    def scores(self, query_embeddings):
+        """
+        Cosine similarity of one or more query embeddings to every domain centroid
         
-        # Get query embedding - use the specialized query embedding method
-        query_embedding = self.embedding_model.get_query_embedding(query)
+        Returns:
+            Array of shape (n_queries, n_domains), columns in domain_names order
+        """
+        queries = np.atleast_2d(np.asarray(query_embeddings, dtype=np.float32))
+        queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+        return queries @ self.centroids.T
+    
+    def classify_query(self, query, query_embedding=None):
+        """
+        Classify a query into a domain
+        
+        Args:
+            query: The query text
+            query_embedding: Precomputed query embedding, to avoid re-embedding the query
+        """
+        override = self._keyword_override(query)
+        if override is not None:
+            return override
         
-        # Calculate similarity to each domain
-        similarities = {}
-        for domain, embedding in self.domain_embeddings.items():
-            similarities[domain] = self.calculate_similarity(query_embedding, embedding)
+        # Get query embedding - use the specialized query embedding method
+        if query_embedding is None:
+            if self.embedding_cache is not None:
+                query_embedding = self.embedding_cache.get_or_compute(query, self.embedding_model.get_query_embedding)
+            else:
+                query_embedding = self.embedding_model.get_query_embedding(query)
         
-        # Select domain with highest similarity
-        best_domain = max(similarities.items(), key=lambda x: x[1])
+        # Select domain with highest similarity (one dot product against all centroids)
+        similarities = self.scores(query_embedding)[0]
+        best = int(np.argmax(similarities))
         
         return {
-            "domain": best_domain[0],
-            "confidence": best_domain[1]
+            "domain": self.domain_names[best],
+            "confidence": float(similarities[best])
         }
     
+    def classify_queries(self, queries, query_embeddings=None):
+        """
+        Classify many queries at once, e.g. for offline routing
+        
+        Args:
+            queries: List of query texts
+            query_embeddings: Optional precomputed (n, dim) embeddings; otherwise the queries
+                              that need one are embedded in a single batch
+        
+        Returns:
+            List of {"domain", "confidence"} dicts in query order
+        """
+        results = [self._keyword_override(query) for query in queries]
+        pending = [i for i, result in enumerate(results) if result is None]
+        if not pending:
+            return results
+        
+        if query_embeddings is not None:
+            embeddings = np.asarray(query_embeddings)[pending]
+        else:
+            embeddings = self._embed_queries([queries[i] for i in pending])
+        
+        similarities = self.scores(embeddings)
+        best = np.argmax(similarities, axis=1)
+        for row, i in enumerate(pending):
+            results[i] = {
+                "domain": self.domain_names[best[row]],
+                "confidence": float(similarities[row, best[row]])
+            }
+        return results
+    
+    def _embed_queries(self, queries):
+        """Query embeddings for a batch, embedding only cache misses in one forward pass"""
+        if self.embedding_cache is None:
+            return self.embedding_model.get_query_embeddings(queries)
+        return self.embedding_cache.get_or_compute_many(queries, self.embedding_model.get_query_embeddings)
+    
     def calculate_similarity(self, embedding1, embedding2):
         """Calculate cosine similarity between embeddings"""
-        return float(cosine_similarity(
-            embedding1.reshape(1, -1), 
-            np.array(embedding2).reshape(1, -1)
-        )[0][0])
+        a = np.asarray(embedding1, dtype=np.float32).reshape(-1)
+        b = np.asarray(embedding2, dtype=np.float32).reshape(-1)
+        return float(a @ b / max(float(np.linalg.norm(a) * np.linalg.norm(b)), 1e-12))
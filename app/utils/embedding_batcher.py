@@ -0,0 +1,114 @@
+import asyncio
+import time
+from .execution import StageOverloadedError
+
+class QueryEmbeddingBatcher:
+    """Coalesce concurrent query-embedding calls into batched forward passes"""
+
+    def __init__(self, embedding_model, max_batch_size=16, max_wait_ms=5.0, runner=None, max_pending=None):
+        """
+        Args:
+            embedding_model: Model exposing get_query_embeddings(list_of_queries)
+            max_batch_size: Largest number of queries sent in one forward pass
+            max_wait_ms: How long the first queued query waits for others to join its batch
+            runner: Optional async callable runner(fn, *args) used to execute the
+                    blocking forward pass; defaults to the loop's default executor
+            max_pending: Most queries waiting for a batch; further queries are
+                    rejected with StageOverloadedError (None for no limit)
+        """
+        self.embedding_model = embedding_model
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.runner = runner or self._run_in_default_executor
+        self.max_pending = max_pending
+
+        self._queue = None
+        self._worker = None
+
+        # Metrics
+        self.batches = 0
+        self.queries = 0
+        self.total_queue_wait_ms = 0.0
+        self.max_queue_wait_ms = 0.0
+        self.rejected = 0
+
+    async def embed(self, query):
+        """
+        Embed a single query, sharing a forward pass with any concurrent callers
+
+        Raises:
+            StageOverloadedError: If max_pending queries are already queued
+        """
+        self._ensure_worker()
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self._queue.put_nowait((query, future, time.perf_counter()))
+        except asyncio.QueueFull:
+            self.rejected += 1
+            raise StageOverloadedError(f"embed stage is overloaded ({self._queue.qsize()} pending)")
+        return await future
+
+    def _ensure_worker(self):
+        """Start the batching loop on the running event loop on first use"""
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue(maxsize=self.max_pending or 0)
+            self._worker = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait_ms / 1000
+
+            # Keep collecting until the batch is full or the wait window closes
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            await self._process_batch(batch)
+
+    async def _process_batch(self, batch):
+        started = time.perf_counter()
+        queries = [query for query, _, _ in batch]
+
+        for _, _, enqueued in batch:
+            wait_ms = (started - enqueued) * 1000
+            self.total_queue_wait_ms += wait_ms
+            self.max_queue_wait_ms = max(self.max_queue_wait_ms, wait_ms)
+        self.batches += 1
+        self.queries += len(batch)
+
+        try:
+            # Run the forward pass off the event loop
+            embeddings = await self.runner(self.embedding_model.get_query_embeddings, queries)
+        except Exception as e:
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (_, future, _), embedding in zip(batch, embeddings):
+            if not future.done():
+                future.set_result(embedding)
+
+    @staticmethod
+    async def _run_in_default_executor(fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(None, fn, *args)
+
+    def get_stats(self):
+        """Batch fill and queue wait metrics"""
+        return {
+            "batches": self.batches,
+            "queries": self.queries,
+            "avg_batch_size": round(self.queries / self.batches, 2) if self.batches else 0.0,
+            "avg_batch_fill": round(self.queries / (self.batches * self.max_batch_size), 3) if self.batches else 0.0,
+            "avg_queue_wait_ms": round(self.total_queue_wait_ms / self.queries, 3) if self.queries else 0.0,
+            "max_queue_wait_ms": round(self.max_queue_wait_ms, 3),
+            "queue_depth": self._queue.qsize() if self._queue else 0,
+            "rejected": self.rejected
+        }
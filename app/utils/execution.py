@@ -0,0 +1,78 @@
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+class StageOverloadedError(Exception):
+    """Raised when a stage already has its maximum number of pending calls"""
+
+class StageTimeoutError(Exception):
+    """Raised when a stage call does not finish within its timeout"""
+
+class InferenceExecutor:
+    """Bounded worker pools that keep blocking model inference off the event loop"""
+
+    def __init__(self, stages):
+        """
+        Args:
+            stages: Dict mapping stage name to {"workers", "max_pending", "timeout"}.
+                    max_pending counts running plus queued calls; timeout is in seconds.
+        """
+        self.stages = {}
+        for name, config in stages.items():
+            self.stages[name] = {
+                "pool": ThreadPoolExecutor(max_workers=config.get("workers", 1), thread_name_prefix=name),
+                "max_pending": config.get("max_pending", 32),
+                "timeout": config.get("timeout"),
+                "pending": 0,
+                "completed": 0,
+                "rejected": 0,
+                "timed_out": 0
+            }
+        self._lock = threading.Lock()
+
+    async def run(self, stage, fn, *args, **kwargs):
+        """
+        Run a blocking call on a stage's pool and await its result
+
+        Raises:
+            StageOverloadedError: If the stage's pending queue is full
+            StageTimeoutError: If the call exceeds the stage's timeout
+        """
+        state = self.stages[stage]
+
+        with self._lock:
+            if state["pending"] >= state["max_pending"]:
+                state["rejected"] += 1
+                raise StageOverloadedError(f"{stage} stage is overloaded ({state['pending']} pending)")
+            state["pending"] += 1
+
+        future = asyncio.get_running_loop().run_in_executor(
+            state["pool"], functools.partial(fn, *args, **kwargs)
+        )
+        # Release the slot when the worker actually finishes, even after a timeout
+        future.add_done_callback(lambda _: self._release(stage))
+
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), state["timeout"])
+        except asyncio.TimeoutError:
+            with self._lock:
+                state["timed_out"] += 1
+            raise StageTimeoutError(f"{stage} stage timed out after {state['timeout']}s")
+
+    def _release(self, stage):
+        with self._lock:
+            self.stages[stage]["pending"] -= 1
+            self.stages[stage]["completed"] += 1
+
+    def get_stats(self):
+        """Pending, completed, rejected and timed-out counts per stage"""
+        with self._lock:
+            return {
+                name: {key: state[key] for key in ("pending", "max_pending", "completed", "rejected", "timed_out")}
+                for name, state in self.stages.items()
+            }
+
+    def shutdown(self):
+        for state in self.stages.values():
+            state["pool"].shutdown(wait=False)
@@ -0,0 +1,184 @@
+import asyncio
+import time
+from .execution import StageOverloadedError, StageTimeoutError
+
+class GenerationScheduler:
+    """
+    Group concurrently pending generation requests into padded batches
+
+    Each batch is led by the oldest waiting request, so nothing starves, and
+    is filled with other waiting requests whose prompts are of similar length,
+    so a long prompt does not pad (and slow down) a batch of short ones.
+    """
+
+    def __init__(self, text_generator, max_batch_size=8, max_wait_ms=20.0, length_ratio=2.0,
+                 max_concurrent_batches=1, runner=None, max_pending=None, timeout=None):
+        """
+        Args:
+            text_generator: TextGenerator exposing generate_batch() and build_input_ids()
+            max_batch_size: Most requests per generate() call
+            max_wait_ms: How long the first pending request waits for others to join
+            length_ratio: Largest prompt length ratio allowed within one batch
+            max_concurrent_batches: Batches allowed in flight at once; while all are
+                    busy, new requests keep accumulating into the next batch
+            runner: Optional async callable runner(fn, *args) used to execute the
+                    blocking generate call; defaults to the loop's default executor
+            max_pending: Most requests waiting for a batch; further requests are
+                    rejected with StageOverloadedError (None for no limit)
+            timeout: Seconds a request may wait for its result, queueing included,
+                    before StageTimeoutError (None for no limit)
+        """
+        self.text_generator = text_generator
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.length_ratio = length_ratio
+        self.max_concurrent_batches = max_concurrent_batches
+        self.runner = runner or self._run_in_default_executor
+        self.max_pending = max_pending
+        self.timeout = timeout
+
+        self._pending = []
+        self._wakeup = None
+        self._slots = None
+        self._worker = None
+
+        # Metrics
+        self.batches = 0
+        self.requests = 0
+        self.total_queue_wait_ms = 0.0
+        self.max_queue_wait_ms = 0.0
+        self.generation_seconds = 0.0
+        self.rejected = 0
+        self.timed_out = 0
+
+    async def generate(self, query, context_docs, domain="general", max_length=256, input_ids=None):
+        """
+        Generate a response for one request, batched with concurrent callers
+
+        Args:
+            input_ids: Prompt token ids from build_input_ids(), e.g. built in a
+                    worker thread alongside retrieval; built here if not given
+
+        Raises:
+            StageOverloadedError: If max_pending requests are already waiting
+            StageTimeoutError: If the result does not arrive within the timeout
+        """
+        self._ensure_worker()
+        if self.max_pending is not None and len(self._pending) >= self.max_pending:
+            self.rejected += 1
+            raise StageOverloadedError(f"generate stage is overloaded ({len(self._pending)} pending)")
+
+        if input_ids is None:
+            input_ids = self.text_generator.build_input_ids(query, context_docs, domain)
+
+        # The prompt travels with the request, so the batch does not build it again
+        future = asyncio.get_running_loop().create_future()
+        item = {
+            "request": {"query": query, "context_docs": context_docs, "domain": domain,
+                        "max_length": max_length, "input_ids": input_ids},
+            "length": max(1, len(input_ids or ())),
+            "future": future,
+            "enqueued": time.perf_counter()
+        }
+        self._pending.append(item)
+        self._wakeup.set()
+
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), self.timeout)
+        except asyncio.TimeoutError:
+            self.timed_out += 1
+            # Drop the request if no batch has picked it up yet
+            self._pending = [pending for pending in self._pending if pending is not item]
+            raise StageTimeoutError(f"generate stage timed out after {self.timeout}s")
+
+    def free_slots(self):
+        """Requests that can be queued before max_pending is reached (None for no limit)"""
+        if self.max_pending is None:
+            return None
+        return max(self.max_pending - len(self._pending), 0)
+
+    def _ensure_worker(self):
+        """Start the scheduling loop on the running event loop on first use"""
+        if self._worker is None or self._worker.done():
+            self._wakeup = asyncio.Event()
+            self._slots = asyncio.Semaphore(self.max_concurrent_batches)
+            self._worker = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._slots.acquire()
+            if not self._pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+
+            # Give concurrent requests a short window to join the oldest one
+            deadline = self._pending[0]["enqueued"] + self.max_wait_ms / 1000
+            while len(self._pending) < self.max_batch_size:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    break
+
+            loop.create_task(self._process_batch(self._select_batch()))
+
+    def _select_batch(self):
+        """Oldest pending request plus, in arrival order, others of similar prompt length"""
+        head = self._pending[0]
+        batch = [head]
+        for item in self._pending[1:]:
+            if len(batch) >= self.max_batch_size:
+                break
+            ratio = max(item["length"], head["length"]) / min(item["length"], head["length"])
+            if ratio <= self.length_ratio:
+                batch.append(item)
+
+        selected = {id(item) for item in batch}
+        self._pending = [item for item in self._pending if id(item) not in selected]
+        return batch
+
+    async def _process_batch(self, batch):
+        started = time.perf_counter()
+        for item in batch:
+            wait_ms = (started - item["enqueued"]) * 1000
+            self.total_queue_wait_ms += wait_ms
+            self.max_queue_wait_ms = max(self.max_queue_wait_ms, wait_ms)
+        self.batches += 1
+        self.requests += len(batch)
+
+        try:
+            results = await self.runner(self.text_generator.generate_batch, [item["request"] for item in batch])
+        except Exception as e:
+            for item in batch:
+                if not item["future"].done():
+                    item["future"].set_exception(e)
+            return
+        finally:
+            self.generation_seconds += time.perf_counter() - started
+            self._slots.release()
+
+        for item, result in zip(batch, results):
+            if not item["future"].done():
+                item["future"].set_result(result)
+
+    @staticmethod
+    async def _run_in_default_executor(fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(None, fn, *args)
+
+    def get_stats(self):
+        """Batching and throughput metrics"""
+        return {
+            "batches": self.batches,
+            "requests": self.requests,
+            "pending": len(self._pending),
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "avg_batch_size": round(self.requests / self.batches, 2) if self.batches else 0.0,
+            "avg_queue_wait_ms": round(self.total_queue_wait_ms / self.requests, 3) if self.requests else 0.0,
+            "max_queue_wait_ms": round(self.max_queue_wait_ms, 3),
+            "requests_per_s": round(self.requests / self.generation_seconds, 3) if self.generation_seconds else 0.0
+        }
@@ -0,0 +1,208 @@
+import json
+import os
+import re
+import shutil
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+CURRENT_FILE = "CURRENT"
+VERSION_FILE = "version.json"
+
+_VERSION_DIR = re.compile(r"^v(\d+)(\.building)?$")
+
+class StoreVersions:
+    """
+    Immutable, numbered store sets per domain, with a pointer to the live one
+
+    Layout: <root>/<domain>/v<N>/<pdf_file>.store plus v<N>/version.json, and
+    <root>/<domain>/CURRENT naming the version being served. A version is built
+    in v<N>.building and renamed into place when complete, so a crash never
+    leaves a half-built version that could be activated.
+    """
+
+    def __init__(self, root, keep=3):
+        """
+        Args:
+            root: Directory holding one subdirectory per domain
+            keep: Published versions kept per domain (the live one is always kept)
+        """
+        self.root = root
+        self.keep = keep
+        self._lock = threading.Lock()
+
+    def _domain_dir(self, domain):
+        return os.path.join(self.root, domain)
+
+    def _version_dir(self, domain, version, building=False):
+        return os.path.join(self._domain_dir(domain), f"v{version}" + (".building" if building else ""))
+
+    def store_path(self, domain, version, pdf_file, building=False):
+        """Store directory for one PDF within a version"""
+        return os.path.join(self._version_dir(domain, version, building), f"{pdf_file}.store")
+
+    def current_version(self, domain):
+        """Number of the live version, or None if the domain was never versioned"""
+        try:
+            with open(os.path.join(self._domain_dir(domain), CURRENT_FILE)) as f:
+                return json.load(f)["version"]
+        except FileNotFoundError:
+            return None
+
+    def manifest(self, domain, version):
+        """The version.json of a published version, or None"""
+        try:
+            with open(os.path.join(self._version_dir(domain, version), VERSION_FILE)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def current(self, domain):
+        """Manifest of the live version, or None"""
+        version = self.current_version(domain)
+        return self.manifest(domain, version) if version is not None else None
+
+    def versions(self, domain):
+        """Manifests of every published version, oldest first"""
+        numbers = []
+        if os.path.isdir(self._domain_dir(domain)):
+            for name in os.listdir(self._domain_dir(domain)):
+                match = _VERSION_DIR.match(name)
+                if match and not match.group(2):
+                    numbers.append(int(match.group(1)))
+        manifests = [self.manifest(domain, version) for version in sorted(numbers)]
+        return [manifest for manifest in manifests if manifest is not None]
+
+    def begin(self, domain):
+        """Reserve the next version number and create its build directory"""
+        with self._lock:
+            os.makedirs(self._domain_dir(domain), exist_ok=True)
+            numbers = [
+                int(match.group(1))
+                for match in map(_VERSION_DIR.match, os.listdir(self._domain_dir(domain))) if match
+            ]
+            version = max(numbers, default=0) + 1
+            os.makedirs(self._version_dir(domain, version, building=True))
+            return version
+
+    def publish(self, domain, version, pdf_files, **info):
+        """Seal a built version: write its manifest and move it into place (does not activate it)"""
+        manifest = {"version": version, "pdf_files": list(pdf_files), "created_at": time.time(), **info}
+        building = self._version_dir(domain, version, building=True)
+        with open(os.path.join(building, VERSION_FILE), "w") as f:
+            json.dump(manifest, f)
+        os.replace(building, self._version_dir(domain, version))
+        return manifest
+
+    def discard(self, domain, version):
+        """Delete a version that failed to build"""
+        shutil.rmtree(self._version_dir(domain, version, building=True), ignore_errors=True)
+
+    def activate(self, domain, version):
+        """Atomically point the domain at a published version"""
+        if self.manifest(domain, version) is None:
+            raise ValueError(f"Version {version} of {domain} does not exist")
+        pointer = os.path.join(self._domain_dir(domain), CURRENT_FILE)
+        with open(f"{pointer}.tmp", "w") as f:
+            json.dump({"version": version, "activated_at": time.time()}, f)
+        os.replace(f"{pointer}.tmp", pointer)
+
+    def previous_version(self, domain):
+        """The newest published version older than the live one, or None"""
+        current = self.current_version(domain)
+        older = [m["version"] for m in self.versions(domain) if current is None or m["version"] < current]
+        return max(older, default=None)
+
+    def prune(self, domain):
+        """Delete the oldest published versions beyond `keep`, never the live one"""
+        current = self.current_version(domain)
+        versions = [m["version"] for m in self.versions(domain)]
+        for version in versions[:max(len(versions) - self.keep, 0)]:
+            if version != current:
+                # Indexes still serving from these files keep their mappings until released
+                shutil.rmtree(self._version_dir(domain, version), ignore_errors=True)
+
+class IngestionQueue:
+    """
+    Background jobs (ingestion, rollback) run one at a time on a dedicated thread
+
+    Jobs are serialized so two builds never race to publish the same domain,
+    and queries keep being served from the live indexes while a job runs.
+    """
+
+    def __init__(self, max_history=100):
+        """
+        Args:
+            max_history: Finished jobs remembered for status queries
+        """
+        self.max_history = max_history
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ingest")
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def submit(self, kind, domain, fn, *args, **params):
+        """
+        Queue fn(*args) and return the job record
+
+        Args:
+            kind: Job type, e.g. "ingest" or "rollback"
+            domain: Domain the job changes
+            params: Request parameters recorded on the job
+        """
+        job = {
+            "id": uuid.uuid4().hex[:12],
+            "kind": kind,
+            "domain": domain,
+            "params": params,
+            "status": "queued",
+            "submitted_at": time.time(),
+            "started_at": None,
+            "finished_at": None,
+            "result": None,
+            "error": None
+        }
+        with self._lock:
+            self._jobs[job["id"]] = job
+            self._trim()
+        self._executor.submit(self._run, job, fn, args)
+        return dict(job)
+
+    def _run(self, job, fn, args):
+        self._update(job, status="running", started_at=time.time())
+        try:
+            result = fn(*args)
+        except Exception as e:
+            print(f"Ingestion job {job['id']} ({job['kind']} {job['domain']}) failed: {str(e)}")
+            self._update(job, status="failed", error=str(e), finished_at=time.time())
+        else:
+            self._update(job, status="succeeded", result=result, finished_at=time.time())
+
+    def _update(self, job, **fields):
+        with self._lock:
+            job.update(fields)
+
+    def _trim(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job["status"] in ("succeeded", "failed")]
+        for job_id in finished[:max(len(self._jobs) - self.max_history, 0)]:
+            del self._jobs[job_id]
+
+    def get(self, job_id):
+        """A copy of a job record, or None"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def list(self, domain=None):
+        """Copies of remembered jobs, oldest first"""
+        with self._lock:
+            return [dict(job) for job in self._jobs.values() if domain is None or job["domain"] == domain]
+
+    def pending(self):
+        """Jobs queued or running"""
+        with self._lock:
+            return sum(job["status"] in ("queued", "running") for job in self._jobs.values())
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
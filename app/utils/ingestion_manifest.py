@@ -0,0 +1,58 @@
+import hashlib
+
+MANIFEST_FILE = "manifest.json"
+
+def file_sha256(path, block_size=1 << 20):
+    """Content hash of a file, read in blocks"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def chunk_hash(content):
+    """Content address of a single chunk"""
+    return hashlib.sha1(content.encode("utf-8")).hexdigest()
+
+def build_manifest(pdf_sha256, chunker_settings, model_name, chunk_hashes, embedding_backend="torch"):
+    """
+    Describe exactly what a vector store was built from
+
+    Args:
+        pdf_sha256: Hash of the source PDF (None when unknown, e.g. a migrated store)
+        chunker_settings: Dict of chunking parameters
+        model_name: Embedding model that produced the vectors
+        chunk_hashes: Per-row chunk content hashes, in store order
+        embedding_backend: Inference backend of the model ("torch", "int8" or "onnx")
+    """
+    return {
+        "pdf_sha256": pdf_sha256,
+        "chunker": chunker_settings,
+        "model_name": model_name,
+        "embedding_backend": embedding_backend,
+        "chunk_hashes": chunk_hashes
+    }
+
+def _same_embedder(manifest, model_name, embedding_backend):
+    # Stores written before backends were recorded were embedded by the fp32 torch model
+    return (manifest.get("model_name") == model_name
+            and manifest.get("embedding_backend", "torch") == embedding_backend)
+
+def is_current(manifest, pdf_sha256, chunker_settings, model_name, embedding_backend="torch"):
+    """Whether a store built from this manifest can be used as-is"""
+    return bool(manifest) and (
+        manifest.get("pdf_sha256") == pdf_sha256
+        and manifest.get("chunker") == chunker_settings
+        and _same_embedder(manifest, model_name, embedding_backend)
+    )
+
+def reusable_rows(manifest, model_name, embedding_backend="torch"):
+    """
+    Map chunk hash -> store row for vectors that can be reused
+
+    Vectors are only reusable when they came from the same embedding model and
+    backend, so one store never mixes vectors from different backends.
+    """
+    if not manifest or not _same_embedder(manifest, model_name, embedding_backend):
+        return {}
+    return {digest: row for row, digest in enumerate(manifest.get("chunk_hashes", []))}
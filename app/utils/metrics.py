@@ -0,0 +1,193 @@
+import threading
+import time
+from contextlib import contextmanager
+
+# Latency buckets in seconds, from sub-millisecond scoring up to long generations
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def _format_labels(labelnames, values, extra=None):
+    pairs = list(zip(labelnames, values)) + list(extra or [])
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class _Metric:
+    """Named metric with a fixed set of label names; one series per label-value tuple"""
+
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        missing = set(self.labelnames) - set(labels)
+        if missing or len(labels) != len(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._sample_lines())
+        return "\n".join(lines)
+
+class Counter(_Metric):
+    """Monotonically increasing count"""
+
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + amount
+
+    def _sample_lines(self):
+        with self._lock:
+            series = dict(self._series)
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+                for key, value in sorted(series.items())]
+
+class Histogram(_Metric):
+    """Cumulative bucket counts plus sum and count of observed values"""
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._series.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self._series[key] = (counts, total + value)
+
+    def _sample_lines(self):
+        with self._lock:
+            series = {key: (list(counts), total) for key, (counts, total) in self._series.items()}
+
+        lines = []
+        for key, (counts, total) in sorted(series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, [("le", _format_value(bound))])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+class Gauge(_Metric):
+    """Point-in-time values, read from a callback when the registry is rendered"""
+
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labelnames=(), callback=None):
+        """
+        Args:
+            callback: Returns {label value or tuple of label values: value}
+                      (a plain number when the gauge has no labels)
+        """
+        super().__init__(name, documentation, labelnames)
+        self.callback = callback
+
+    def _sample_lines(self):
+        series = {}
+        if self.callback is not None:
+            values = self.callback()
+            if not isinstance(values, dict):
+                values = {(): values}
+            series = {key if isinstance(key, tuple) else (key,): value for key, value in values.items()}
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+                for key, value in sorted(series.items())]
+
+class MetricsRegistry:
+    """Collection of metrics rendered together in the Prometheus text exposition format"""
+
+    def __init__(self):
+        self._metrics = []
+
+    def _register(self, metric):
+        if any(existing.name == metric.name for existing in self._metrics):
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def gauge(self, name, documentation, labelnames=(), callback=None):
+        return self._register(Gauge(name, documentation, labelnames, callback))
+
+    def render(self):
+        blocks = []
+        for metric in self._metrics:
+            try:
+                blocks.append(metric.render())
+            except Exception as e:
+                # A failing gauge callback must not take the whole scrape down
+                print(f"Error rendering metric {metric.name}: {str(e)}")
+        return "\n".join(blocks) + "\n"
+
+class RequestTimer:
+    """
+    Times the stages of one request
+
+    Each span is observed into a shared stage histogram and accumulated into
+    a per-request breakdown that can be returned to the caller.
+    """
+
+    def __init__(self, histogram, **labels):
+        """
+        Args:
+            histogram: Histogram labelled by stage, domain and the given labels
+            labels: Fixed labels for every span, e.g. endpoint="query"
+        """
+        self.histogram = histogram
+        self.labels = labels
+        self.stages = {}
+        # Retrieval path taken ("direct", "general_fallback", ...), set by the pipeline
+        self.path = None
+        self._start = time.perf_counter()
+
+    @contextmanager
+    def span(self, stage, domain=""):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start, domain)
+
+    def record(self, stage, seconds, domain=""):
+        self.histogram.observe(seconds, stage=stage, domain=domain, **self.labels)
+        key = f"{stage}:{domain}" if domain else stage
+        self.stages[key] = self.stages.get(key, 0.0) + seconds
+
+    def elapsed(self):
+        """Seconds since the timer was created"""
+        return time.perf_counter() - self._start
+
+    def breakdown(self):
+        """Milliseconds per stage (per stage:domain for per-domain spans), plus the total"""
+        timings = {key: round(seconds * 1000, 3) for key, seconds in self.stages.items()}
+        timings["total"] = round(self.elapsed() * 1000, 3)
+        return timings
@@ -0,0 +1,11 @@
+from pypdf import PdfReader
+
+def extract_page_range(pdf_path, start, end):
+    """
+    Extract the text of pages [start, end); runs in extraction worker processes
+
+    Kept apart from document_processor so spawned workers import only pypdf,
+    not the embedding model's dependencies.
+    """
+    reader = PdfReader(pdf_path)
+    return [reader.pages[i].extract_text() or "" for i in range(start, end)]
@@ -0,0 +1,137 @@
+import numpy as np
+
+def force_general_domain(query, domain):
+    """Send queries using AI terminology to the general domain, whatever the classifier said"""
+    if "artificial intelligence" in query.lower() or "ai" in query.lower().split():
+        print("Query contains AI terminology, forcing general domain")
+        return "general"
+    return domain
+
+def needs_general_fallback(domain, docs):
+    """True when a specialized domain returned no doc scoring above 0.4"""
+    return domain != "general" and not any(doc.get("score", 0) > 0.4 for doc in docs)
+
+def retrieval_path(domain, docs, used_general_fallback=False):
+    """Label for how a query's documents were found, for request counters"""
+    if all(doc.get("domain") == "unknown" for doc in docs):
+        return "no_results"
+    if used_general_fallback:
+        return "general_fallback"
+    if any(doc.get("domain") != domain for doc in docs):
+        return "cross_domain"
+    return "direct"
+
+class BatchQueryPipeline:
+    """
+    Answer many queries at once, for offline evaluation and replay
+
+    Each chunk of queries is embedded in one forward pass, classified and
+    retrieved with matrix operations, and generated in padded batches of
+    similar prompt length. Results come back chunk by chunk in input order.
+    """
+
+    def __init__(self, embedding_model, classifier, search_engine, text_generator,
+                 embedding_cache=None, chunk_size=32, generation_batch_size=8, top_k=5):
+        """
+        Args:
+            embedding_model: E5 model exposing get_query_embeddings()
+            classifier: DomainClassifier
+            search_engine: SearchEngine
+            text_generator: TextGenerator exposing generate_batch() and build_input_ids()
+            embedding_cache: Optional QueryEmbeddingCache consulted before embedding
+            chunk_size: Queries embedded, routed and retrieved together
+            generation_batch_size: Most prompts per generate() call
+            top_k: Documents retrieved per query
+        """
+        self.embedding_model = embedding_model
+        self.classifier = classifier
+        self.search_engine = search_engine
+        self.text_generator = text_generator
+        self.embedding_cache = embedding_cache
+        self.chunk_size = chunk_size
+        self.generation_batch_size = generation_batch_size
+        self.top_k = top_k
+
+    def embed(self, queries):
+        """(n, dim) query embeddings, computing cache misses in one forward pass"""
+        if self.embedding_cache is not None:
+            return self.embedding_cache.get_or_compute_many(queries, self.embedding_model.get_query_embeddings)
+        return self.embedding_model.get_query_embeddings(queries)
+
+    def route(self, queries, query_embeddings):
+        """List of (domain, confidence) per query, classified with one matrix product"""
+        classifications = self.classifier.classify_queries(queries, query_embeddings=query_embeddings)
+        return [
+            (force_general_domain(query, c["domain"]), float(c["confidence"]))
+            for query, c in zip(queries, classifications)
+        ]
+
+    def retrieve(self, queries, domains, query_embeddings):
+        """Supporting documents per query, with the same general-domain fallback as /query"""
+        docs = self.search_engine.search_batch(
+            queries, domains, top_k=self.top_k, query_embeddings=query_embeddings
+        )
+
+        fallback = [i for i, domain in enumerate(domains) if needs_general_fallback(domain, docs[i])]
+        if fallback:
+            general_docs = self.search_engine.search_batch(
+                [queries[i] for i in fallback], ["general"] * len(fallback),
+                top_k=3, query_embeddings=np.asarray(query_embeddings)[fallback]
+            )
+            for i, extra in zip(fallback, general_docs):
+                docs[i] = extra + docs[i]
+        return docs
+
+    def generate(self, requests):
+        """
+        Responses for generation requests, batched by similar prompt length
+
+        Args:
+            requests: List of dicts as accepted by TextGenerator.generate_batch()
+        """
+        # Build each prompt once; generate_batch() reuses the ids
+        requests = [
+            {**r, "input_ids": self.text_generator.build_input_ids(r["query"], r["context_docs"], r.get("domain", "general"))}
+            for r in requests
+        ]
+        order = np.argsort([len(r["input_ids"] or ()) for r in requests], kind="stable")
+
+        responses = [None] * len(requests)
+        for start in range(0, len(order), self.generation_batch_size):
+            batch = order[start:start + self.generation_batch_size]
+            for i, response in zip(batch, self.text_generator.generate_batch([requests[i] for i in batch])):
+                responses[i] = response
+        return responses
+
+    def run_chunk(self, requests):
+        """
+        Answer one chunk of requests
+
+        Args:
+            requests: List of {"query", optional "max_length"} dicts
+
+        Returns:
+            List of {"response", "sources", "domain", "confidence"} dicts in request order
+        """
+        queries = [request["query"] for request in requests]
+        query_embeddings = self.embed(queries)
+        routes = self.route(queries, query_embeddings)
+        domains = [domain for domain, _ in routes]
+        docs = self.retrieve(queries, domains, query_embeddings)
+
+        responses = self.generate([
+            {"query": query, "context_docs": context_docs, "domain": domain,
+             "max_length": request.get("max_length") or 256}
+            for request, query, context_docs, domain in zip(requests, queries, docs, domains)
+        ])
+
+        return [
+            {"response": response["response"], "sources": context_docs,
+             "domain": domain, "confidence": confidence}
+            for response, context_docs, (domain, confidence) in zip(responses, docs, routes)
+        ]
+
+    def run(self, requests):
+        """Yield one result dict per request, in order, processing chunk_size requests at a time"""
+        for start in range(0, len(requests), self.chunk_size):
+            yield from self.run_chunk(requests[start:start + self.chunk_size])
@@ -1,22 +1,85 @@
+import threading
 import numpy as np
-from sklearn.metrics.pairwise import cosine_similarity
+from .vector_index import DomainIndex, top_k_indices
+from .bm25_index import tokenize
+from .sketch_index import SKETCH_KINDS
+
+# Fusion weights for semantic (cosine) and keyword (BM25) scores
+SEMANTIC_WEIGHT = 0.7
+KEYWORD_WEIGHT = 0.3
+# Fused score a document must exceed to be returned
+MIN_SCORE = 0.2
 
 class SearchEngine:
     """Improved search for relevant documents based on query embeddings"""
     
-    def __init__(self, document_collections=None):
+    def __init__(self, document_collections=None, index_backend="exact", index_params=None,
+                 ann_candidate_factor=4, rerank_candidates=300):
         """
         Initialize with document collections
         document_collections: Dict[str, List[Document]] mapping domain names to document lists
+        index_backend: "exact" (brute-force matrix scoring), a FAISS index kind: "ivf", "hnsw"
+                       ("flat" is brute force too, so it is served by exact scoring),
+                       or a sketch kind for prefilter-and-rerank: "binary", "projection"
+        index_params: FAISS build/search parameters, e.g. {"nlist": 256, "nprobe": 8, "ef_search": 64},
+                      or sketch parameters, e.g. {"sketch_dim": 128, "seed": 0}
+        ann_candidate_factor: ANN candidates fetched per requested result (at least rerank_candidates)
+        rerank_candidates: ANN / sketch candidates rescored exactly per domain; the ANN path adds as
+                           many of the best keyword matches
         """
         self.document_collections = document_collections or {}
         self.embedding_model = None
+        self.embedding_cache = None
+        self.index_backend = index_backend
+        self.index_params = index_params or {}
+        self.ann_candidate_factor = ann_candidate_factor
+        self.rerank_candidates = rerank_candidates
+        
+        # Compile each collection into a matrix-backed index once, up front
+        self.indexes = {
+            domain_name: self._build_index(docs)
+            for domain_name, docs in self.document_collections.items()
+        }
+        
+        # Bumped whenever a collection is rebuilt, so cached responses can be invalidated
+        self.index_version = 0
+        # Serializes swaps: domains are published from startup and ingestion threads
+        self._update_lock = threading.Lock()
+    
+    def _build_index(self, docs):
+        """Compile a collection, attaching an ANN index or sketch for non-exact backends"""
+        index = DomainIndex(docs)
+        if self.index_backend in SKETCH_KINDS:
+            index.attach_sketch(self.index_backend, **self.index_params)
+        elif self.index_backend not in ("exact", "flat"):
+            params = dict(self.index_params)
+            search_params = {key: params.pop(key) for key in ("nprobe", "ef_search") if key in params}
+            index.attach_ann(self.index_backend, build_params=params, **search_params)
+        return index
     
     def set_embedding_model(self, embedding_model):
         """Set the embedding model to use for queries"""
         self.embedding_model = embedding_model
     
-    def search(self, query, domain=None, top_k=5):
+    def set_embedding_cache(self, embedding_cache):
+        """Set a QueryEmbeddingCache consulted before embedding a query"""
+        self.embedding_cache = embedding_cache
+    
+    def update_collection(self, domain, documents):
+        """Replace (or add) a domain's collection and rebuild its index"""
+        index = self._build_index(documents)
+        # Swap in new dicts rather than mutating, so concurrent searches iterating
+        # the old ones are unaffected; the lock keeps concurrent updates from
+        # overwriting each other's domain
+        with self._update_lock:
+            self.document_collections = {**self.document_collections, domain: documents}
+            self.indexes = {**self.indexes, domain: index}
+            self.index_version += 1
+    
+    def shutdown(self):
+        """Release background resources; in-process search holds none"""
+    
+    def search(self, query, domain=None, top_k=5, query_embedding=None):
         """
         Search for relevant documents
         
@@ -24,61 +87,84 @@ class SearchEngine:
             query: The search query
             domain: Specific domain to search (e.g., 'clinical', 'food_security')
             top_k: Number of results to return
+            query_embedding: Precomputed query embedding, to avoid re-embedding the query
             
         Returns:
             List of relevant documents with similarity scores
         """
-        if not self.embedding_model:
-            raise ValueError("Embedding model must be set before searching")
-            
-        # Get query embedding - use the specialized query embedding method
-        query_embedding = self.embedding_model.get_query_embedding(query)
+        query_embedding = self._query_embedding(query, query_embedding)
         
         # Extract key terms for keyword boosting
         key_terms = self._extract_key_terms(query)
         
         results = []
         
-        # Determine which collections to search
-        collections_to_search = {}
-        if domain and domain in self.document_collections:
-            collections_to_search[domain] = self.document_collections[domain]
-        else:
-            collections_to_search = self.document_collections
+        # Score each collection (one matrix-vector product, an ANN lookup, or a sketch prefilter)
+        for domain_name, index in self._indexes_to_search(domain).items():
+            results.extend(self._search_index(index, domain_name, query_embedding, key_terms, top_k))
         
-        # Search each collection
-        for domain_name, docs in collections_to_search.items():
-            domain_results = []
-            
-            for doc in docs:
-                # Base semantic similarity score (cosine)
-                if "embedding" in doc:
-                    embedding_similarity = self._calculate_similarity(query_embedding, doc["embedding"])
-                    
-                    # Additional keyword-based boosting
-                    keyword_boost = self._calculate_keyword_boost(doc["content"], key_terms)
-                    
-                    # Combined score with both semantic and keyword components
-                    combined_score = (0.7 * embedding_similarity) + (0.3 * keyword_boost)
-                    
-                    # Only include docs with reasonable similarity
-                    if combined_score > 0.2:  # Minimum threshold
-                        domain_results.append({
-                            "content": doc["content"],
-                            "metadata": doc.get("metadata", {}),
-                            "score": float(combined_score),
-                            "domain": domain_name
-                        })
+        return self._finish(query, domain, top_k, query_embedding, results)
+    
+    def _query_embedding(self, query, query_embedding=None):
+        """The given query embedding, or the query embedded (through the cache when set)"""
+        if query_embedding is not None:
+            return query_embedding
+        if not self.embedding_model:
+            raise ValueError("Embedding model must be set before searching")
+        
+        # Get query embedding - use the specialized query embedding method
+        if self.embedding_cache is not None:
+            return self.embedding_cache.get_or_compute(query, self.embedding_model.get_query_embedding)
+        return self.embedding_model.get_query_embedding(query)
+    
+    def _indexes_to_search(self, domain):
+        """The requested domain's index, or every index when the domain is unknown or None"""
+        if domain and domain in self.indexes:
+            return {domain: self.indexes[domain]}
+        return self.indexes
+    
+    def _search_index(self, index, domain_name, query_embedding, key_terms, top_k):
+        """Top-k result dicts from one in-process collection"""
+        if not len(index):
+            return []
+        
+        if index.ann is not None:
+            # Dense candidates from the ANN index plus the best keyword matches, so documents the
+            # fused score favours for their keywords are not lost; all rescored exactly below
+            _, dense_ids = index.ann_search(
+                query_embedding, max(self.rerank_candidates, top_k * self.ann_candidate_factor)
+            )
+            keyword_boost = index.keyword_boost(key_terms)
+            doc_ids = np.union1d(dense_ids, top_k_indices(keyword_boost, self.rerank_candidates, threshold=0))
+            embedding_similarity = index.similarities(query_embedding, doc_ids)
+            keyword_boost = keyword_boost[doc_ids]
+        elif index.sketch is not None and len(index) > self.rerank_candidates:
+            # Cheap sketch prefilter, then exact cosine + BM25 on the candidates only
+            doc_ids = index.sketch_candidates(query_embedding, self.rerank_candidates)
+            embedding_similarity = index.similarities(query_embedding, doc_ids)
+            keyword_boost = index.keyword_boost(key_terms)[doc_ids]
+        else:
+            # Base semantic similarity score (cosine)
+            embedding_similarity = index.similarities(query_embedding)
+            doc_ids = None
             
-            results.extend(domain_results)
+            # Additional keyword-based boosting (BM25 over the inverted index)
+            keyword_boost = index.keyword_boost(key_terms)
         
+        # Fused score with both semantic and keyword components
+        combined_scores = (SEMANTIC_WEIGHT * embedding_similarity) + (KEYWORD_WEIGHT * keyword_boost)
+        
+        return self._collect(index, domain_name, combined_scores, top_k, doc_ids)
+    
+    def _finish(self, query, domain, top_k, query_embedding, results):
+        """Merge per-collection results, falling back to all domains and then a placeholder"""
         # Sort by score and take top-k
         results = sorted(results, key=lambda x: x["score"], reverse=True)[:top_k]
         
         # If no results found, try cross-domain search
         if not results and domain:
             print(f"No results in {domain} domain, searching all domains")
-            return self.search(query, domain=None, top_k=top_k)
+            return self.search(query, domain=None, top_k=top_k, query_embedding=query_embedding)
             
         # If still no results, add placeholder
         if not results:
@@ -92,28 +178,80 @@ class SearchEngine:
         
         return results
     
-    def _calculate_similarity(self, query_embedding, doc_embedding):
-        """Calculate cosine similarity between query and document"""
-        query_embedding = query_embedding.reshape(1, -1)
-        doc_embedding = np.array(doc_embedding).reshape(1, -1)
-        return float(cosine_similarity(query_embedding, doc_embedding)[0][0])
-    
-    def _extract_key_terms(self, query):
-        """Extract important terms from the query"""
-        # Basic approach: remove stop words and get unique terms
-        stop_words = {'the', 'is', 'and', 'of', 'to', 'a', 'in', 'that', 'for'}
-        terms = [word.lower() for word in query.split() if word.lower() not in stop_words]
-        return set(terms)
-    
-    def _calculate_keyword_boost(self, content, key_terms):
-        """Calculate keyword-based relevance boost"""
-        if not content or not key_terms:
-            return 0.0
+    def search_batch(self, queries, domains, top_k=5, query_embeddings=None):
+        """
+        Search many queries at once
+        
+        Queries routed to the same exact-scored domain share one matrix-matrix
+        product against its embeddings; other queries go through search().
+        
+        Args:
+            queries: List of search queries
+            domains: Domain to search for each query (None searches all domains)
+            top_k: Number of results per query
+            query_embeddings: Precomputed (n, dim) query embeddings
             
-        content_lower = content.lower()
-        term_count = sum(1 for term in key_terms if term in content_lower)
+        Returns:
+            List of result lists, in query order (as from search())
+        """
+        query_embeddings = self._query_embeddings(queries, query_embeddings)
         
-        # Normalize by total key terms
-        if len(key_terms) > 0:
-            return term_count / len(key_terms)
-        return 0.0
+        results = [None] * len(queries)
+        groups = {}
+        for i, domain in enumerate(domains):
+            index = self.indexes.get(domain) if domain else None
+            if index is not None and len(index) and index.ann is None and index.sketch is None:
+                groups.setdefault(domain, []).append(i)
+            else:
+                results[i] = self.search(queries[i], domain=domain, top_k=top_k,
+                                         query_embedding=query_embeddings[i])
+        
+        for domain_name, positions in groups.items():
+            index = self.indexes[domain_name]
+            matrix = query_embeddings[positions]
+            matrix = matrix / np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+            # (n_docs, n_queries) cosine similarities in one product
+            similarities = index.embeddings @ matrix.T
+            
+            for column, i in enumerate(positions):
+                keyword_boost = index.keyword_boost(self._extract_key_terms(queries[i]))
+                combined_scores = (SEMANTIC_WEIGHT * similarities[:, column]) + (KEYWORD_WEIGHT * keyword_boost)
+                results[i] = self._collect(index, domain_name, combined_scores, top_k)
+                if not results[i]:
+                    # Same cross-domain fallback as search()
+                    print(f"No results in {domain_name} domain, searching all domains")
+                    results[i] = self.search(queries[i], domain=None, top_k=top_k,
+                                             query_embedding=query_embeddings[i])
+        
+        return results
+    
+    def _query_embeddings(self, queries, query_embeddings=None):
+        """(n, dim) float32 embeddings for a batch, embedding (cache misses) in one forward pass if not given"""
+        if query_embeddings is None:
+            if not self.embedding_model:
+                raise ValueError("Embedding model must be set before searching")
+            if self.embedding_cache is not None:
+                query_embeddings = self.embedding_cache.get_or_compute_many(
+                    queries, self.embedding_model.get_query_embeddings
+                )
+            else:
+                query_embeddings = self.embedding_model.get_query_embeddings(queries)
+        return np.asarray(query_embeddings, dtype=np.float32)
+    
+    def _collect(self, index, domain_name, combined_scores, top_k, doc_ids=None):
+        """Result dicts for a collection's top-k fused scores above the minimum threshold"""
+        results = []
+        # Only include docs with reasonable similarity (minimum threshold)
+        for j in index.top_k(combined_scores, top_k, threshold=MIN_SCORE):
+            i = doc_ids[j] if doc_ids is not None else j
+            results.append({
+                "content": index.contents[i],
+                "metadata": index.metadatas[i],
+                "score": float(combined_scores[j]),
+                "domain": domain_name
+            })
+        return results
+    
+    def _extract_key_terms(self, query):
+        """Extract important terms from the query, tokenized like the BM25 index"""
+        return set(tokenize(query))
@@ -0,0 +1,289 @@
+import math
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import numpy as np
+from .bm25_index import BM25Index
+from .search_engine import SearchEngine, SEMANTIC_WEIGHT, KEYWORD_WEIGHT, MIN_SCORE
+from .vector_index import top_k_indices
+from .vector_store import VectorStore, EMBEDDINGS_FILE, load_vector_store
+
+# Per worker process: store path -> (version token, embeddings, BM25 index, inverse row norms or None)
+_worker_stores = {}
+
+def _open_store(path, token):
+    """Memory-map a store (and load its BM25 index) once per worker and store version"""
+    entry = _worker_stores.get(path)
+    if entry is None or entry[0] != token:
+        store = load_vector_store(path, lazy_texts=True)
+        bm25 = BM25Index.load(path)
+        if bm25 is None or len(bm25) != len(store):
+            bm25 = BM25Index.build(store.contents)
+
+        inv_norms = None
+        if not (store.normalized and store.embeddings.dtype == np.float32):
+            norms = np.concatenate([
+                np.linalg.norm(np.asarray(store.embeddings[start:start + 4096], dtype=np.float32), axis=1)
+                for start in range(0, len(store), 4096)
+            ])
+            inv_norms = 1.0 / np.maximum(norms, 1e-12)
+
+        entry = _worker_stores[path] = (token, store.embeddings, bm25, inv_norms)
+    return entry[1:]
+
+def _evict_stores(live_paths):
+    """Release stores no longer served (e.g. pruned versions), so their files can be freed"""
+    for path in [path for path in _worker_stores if path not in live_paths]:
+        del _worker_stores[path]
+
+def search_shard(path, token, start, end, query_matrix, key_terms, top_k, live_paths=None):
+    """
+    Score a slice of one store against a batch of queries (runs in a shard worker)
+
+    Args:
+        path: Store directory
+        token: Store version token, so a rewritten store is re-opened
+        start, end: Row range of the shard
+        query_matrix: (n_queries, dim) L2-normalized query embeddings
+        key_terms: One set of key terms per query
+        top_k: Results kept per query
+        live_paths: Every store path the engine currently serves; mappings of
+                    any other store are dropped
+
+    Returns:
+        One (row ids within the store, fused scores) pair per query, best first
+    """
+    if live_paths is not None:
+        _evict_stores(live_paths)
+    embeddings, bm25, inv_norms = _open_store(path, token)
+
+    # (rows, n_queries) cosine similarities in one product over the shared mapping
+    similarities = np.asarray(embeddings[start:end], dtype=np.float32) @ query_matrix.T
+    if inv_norms is not None:
+        similarities *= inv_norms[start:end, None]
+
+    hits = []
+    for column, terms in enumerate(key_terms):
+        combined_scores = SEMANTIC_WEIGHT * similarities[:, column]
+        if terms:
+            combined_scores = combined_scores + KEYWORD_WEIGHT * bm25.score(terms)[start:end]
+        ids = top_k_indices(combined_scores, top_k, threshold=MIN_SCORE)
+        hits.append((ids + start, combined_scores[ids]))
+    return hits
+
+def store_token(path):
+    """Version token for a store directory; changes whenever the store is rewritten"""
+    return os.stat(os.path.join(path, EMBEDDINGS_FILE)).st_mtime_ns
+
+class ShardedCollection:
+    """
+    A domain collection served by shard workers
+
+    Each on-disk store is split into row ranges; workers memory-map the store
+    files, so every process shares one copy of the matrix through the page
+    cache. Give it stores opened with lazy_texts so the API process decodes
+    chunk texts only for the results it returns.
+    """
+
+    def __init__(self, stores, rows_per_shard):
+        """
+        Args:
+            stores: VectorStores loaded from disk (each with a path)
+            rows_per_shard: Most rows scored by a single worker task
+        """
+        self.stores = [store for store in stores if len(store)]
+        self.shards = []
+        for i, store in enumerate(self.stores):
+            # Workers load the persisted keyword index rather than rebuilding it each
+            bm25 = BM25Index.load(store.path)
+            if bm25 is None or len(bm25) != len(store):
+                BM25Index.build(store.contents).save(store.path)
+
+            token = store_token(store.path)
+            for start in range(0, len(store), rows_per_shard):
+                self.shards.append({
+                    "store": i,
+                    "path": store.path,
+                    "token": token,
+                    "start": start,
+                    "end": min(start + rows_per_shard, len(store))
+                })
+
+    def __len__(self):
+        return sum(len(store) for store in self.stores)
+
+    def embedding_blocks(self):
+        """One embedding matrix per store, e.g. for computing domain centroids"""
+        return [store.embeddings for store in self.stores]
+
+    def memory_bytes(self):
+        """Bytes of the mapped embedding matrices (shared with the shard workers)"""
+        return sum(store.embeddings.nbytes for store in self.stores)
+
+    def result(self, domain_name, store_index, row, score):
+        store = self.stores[store_index]
+        return {
+            "content": store.contents[row],
+            "metadata": store.metadatas[row],
+            "score": float(score),
+            "domain": domain_name
+        }
+
+class ShardedSearchEngine(SearchEngine):
+    """
+    Search engine that scatters queries to shard worker processes and merges their top-k
+
+    Domains given as a list of on-disk VectorStores are split into row-range
+    shards scored exactly (cosine + BM25) by a process pool, so scoring runs
+    on every core and the corpus is mapped once rather than copied per worker.
+    Other collections (in-memory stores, document lists) are searched
+    in-process as by SearchEngine, including its ANN and sketch backends.
+    Keyword scores are computed per store, so BM25 statistics are per PDF
+    rather than over the whole domain.
+    """
+
+    def __init__(self, document_collections=None, workers=None, rows_per_shard=None,
+                 min_rows_per_shard=20000, **kwargs):
+        """
+        Args:
+            document_collections: As for SearchEngine; a list of VectorStores is sharded
+            workers: Shard worker processes (defaults to the CPU count)
+            rows_per_shard: Fixed shard size; by default each store is split across
+                            all workers, but never into shards below min_rows_per_shard
+            kwargs: Passed to SearchEngine
+        """
+        self.workers = workers or os.cpu_count() or 2
+        self.rows_per_shard = rows_per_shard
+        self.min_rows_per_shard = min_rows_per_shard
+        self._pool = None
+        super().__init__(document_collections, **kwargs)
+
+    def _build_index(self, docs):
+        """Shard lists of on-disk stores; compile anything else in-process"""
+        if isinstance(docs, list) and all(isinstance(doc, VectorStore) for doc in docs):
+            if all(store.path for store in docs):
+                return ShardedCollection(docs, self._rows_per_shard(docs))
+            docs = VectorStore.concatenate(docs)
+        return super()._build_index(docs)
+
+    def _rows_per_shard(self, stores):
+        if self.rows_per_shard:
+            return self.rows_per_shard
+        largest = max((len(store) for store in stores), default=0)
+        return max(self.min_rows_per_shard, math.ceil(largest / self.workers), 1)
+
+    def _get_pool(self):
+        if self._pool is None:
+            # Spawned (not forked) workers: the API process holds model threads and locks
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=multiprocessing.get_context("spawn")
+            )
+        return self._pool
+
+    def shutdown(self):
+        """Stop the shard worker processes"""
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    def _scatter(self, collection, query_matrix, key_terms, top_k):
+        """Submit a batch of queries to every shard of a collection"""
+        query_matrix = np.asarray(query_matrix, dtype=np.float32)
+        query_matrix = query_matrix / np.maximum(np.linalg.norm(query_matrix, axis=1, keepdims=True), 1e-12)
+
+        live_paths = frozenset(
+            store.path for index in self.indexes.values() if isinstance(index, ShardedCollection)
+            for store in index.stores
+        )
+        pool = self._get_pool()
+        return [
+            (shard["store"], pool.submit(
+                search_shard, shard["path"], shard["token"], shard["start"], shard["end"],
+                query_matrix, key_terms, top_k, live_paths
+            ))
+            for shard in collection.shards
+        ]
+
+    def _gather(self, collection, domain_name, futures, n_queries, top_k):
+        """Merge per-shard top-k hits into one result list per query"""
+        hits = [[] for _ in range(n_queries)]
+        try:
+            for store_index, future in futures:
+                for column, (rows, scores) in enumerate(future.result()):
+                    hits[column].extend(zip(scores.tolist(), [store_index] * len(rows), rows.tolist()))
+        except BrokenProcessPool:
+            # A worker died; start a fresh pool for the next request
+            print(f"Shard worker failed while searching {domain_name}, restarting the pool")
+            self._pool = None
+            raise
+
+        return [
+            [collection.result(domain_name, store_index, row, score)
+             for score, store_index, row in sorted(query_hits, key=lambda hit: (-hit[0], hit[1], hit[2]))[:top_k]]
+            for query_hits in hits
+        ]
+
+    def search(self, query, domain=None, top_k=5, query_embedding=None):
+        """Search as SearchEngine.search, scattering sharded domains before scoring the rest"""
+        query_embedding = self._query_embedding(query, query_embedding)
+        key_terms = self._extract_key_terms(query)
+
+        indexes = self._indexes_to_search(domain)
+        scattered = {
+            domain_name: self._scatter(index, np.atleast_2d(query_embedding), [key_terms], top_k)
+            for domain_name, index in indexes.items()
+            if isinstance(index, ShardedCollection) and len(index)
+        }
+
+        results = []
+        for domain_name, index in indexes.items():
+            if not isinstance(index, ShardedCollection):
+                results.extend(self._search_index(index, domain_name, query_embedding, key_terms, top_k))
+        for domain_name, futures in scattered.items():
+            results.extend(self._gather(indexes[domain_name], domain_name, futures, 1, top_k)[0])
+
+        return self._finish(query, domain, top_k, query_embedding, results)
+
+    def search_batch(self, queries, domains, top_k=5, query_embeddings=None):
+        """Search many queries, sending each sharded domain's queries to its shards as one matrix"""
+        query_embeddings = self._query_embeddings(queries, query_embeddings)
+
+        results = [None] * len(queries)
+        groups = {}
+        local = []
+        for i, domain in enumerate(domains):
+            index = self.indexes.get(domain) if domain else None
+            if isinstance(index, ShardedCollection) and len(index):
+                groups.setdefault(domain, []).append(i)
+            else:
+                local.append(i)
+
+        scattered = {
+            domain_name: self._scatter(
+                self.indexes[domain_name], query_embeddings[positions],
+                [self._extract_key_terms(queries[i]) for i in positions], top_k
+            )
+            for domain_name, positions in groups.items()
+        }
+
+        if local:
+            local_results = super().search_batch(
+                [queries[i] for i in local], [domains[i] for i in local],
+                top_k=top_k, query_embeddings=query_embeddings[local]
+            )
+            for i, docs in zip(local, local_results):
+                results[i] = docs
+
+        for domain_name, positions in groups.items():
+            gathered = self._gather(self.indexes[domain_name], domain_name, scattered[domain_name],
+                                    len(positions), top_k)
+            for i, docs in zip(positions, gathered):
+                results[i] = docs
+                if not docs:
+                    # Same cross-domain fallback as search()
+                    print(f"No results in {domain_name} domain, searching all domains")
+                    results[i] = self.search(queries[i], domain=None, top_k=top_k,
+                                             query_embedding=query_embeddings[i])
+
+        return results
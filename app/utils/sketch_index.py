@@ -0,0 +1,180 @@
+import argparse
+import json
+import os
+import time
+import numpy as np
+
+SKETCH_KINDS = ("binary", "projection")
+
+# Set bits per 16-bit value, for numpy builds without np.bitwise_count (< 2.0)
+_POPCOUNT16 = None if hasattr(np, "bitwise_count") else np.array(
+    [bin(i).count("1") for i in range(1 << 16)], dtype=np.uint8
+)
+
+def hamming_distances(codes, query_code):
+    """Hamming distance of a packed query code to every row of packed codes"""
+    if codes.shape[1] % 8 == 0 and codes.flags.c_contiguous:
+        # Compare 64 dimensions per operation
+        codes, query_code = codes.view(np.uint64), query_code.view(np.uint64)
+    if _POPCOUNT16 is None:
+        return np.bitwise_count(codes ^ query_code).sum(axis=1, dtype=np.uint16)
+    if codes.dtype == np.uint8 and codes.shape[1] % 2:
+        return np.unpackbits(codes ^ query_code, axis=1).sum(axis=1, dtype=np.uint16)
+    return _POPCOUNT16[(codes ^ query_code).view(np.uint16)].sum(axis=1, dtype=np.uint16)
+
+class BinarySketch:
+    """Sign-bit codes of the embeddings (1 bit per dimension) ranked by Hamming distance"""
+
+    kind = "binary"
+
+    def __init__(self, codes):
+        self.codes = codes
+
+    @classmethod
+    def build(cls, embeddings):
+        return cls(np.packbits(np.asarray(embeddings) > 0, axis=1))
+
+    @staticmethod
+    def file_name():
+        return "sketch_binary.npy"
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes
+
+    def candidates(self, query_embedding, n):
+        query_code = np.packbits(np.asarray(query_embedding).reshape(1, -1) > 0, axis=1)
+        distances = hamming_distances(self.codes, query_code)
+        n = min(n, len(distances))
+        return np.argpartition(distances, n - 1)[:n]
+
+class ProjectionSketch:
+    """Seeded Gaussian random projection of the embeddings to a few dimensions"""
+
+    kind = "projection"
+
+    def __init__(self, sketches, projection):
+        self.sketches = sketches
+        self.projection = projection
+
+    @staticmethod
+    def make_projection(dim, sketch_dim=128, seed=0):
+        rng = np.random.default_rng(seed)
+        return (rng.standard_normal((dim, sketch_dim)) / np.sqrt(sketch_dim)).astype(np.float32)
+
+    @classmethod
+    def build(cls, embeddings, sketch_dim=128, seed=0):
+        matrix = np.asarray(embeddings, dtype=np.float32)
+        projection = cls.make_projection(matrix.shape[1], sketch_dim, seed)
+        return cls(np.ascontiguousarray(matrix @ projection), projection)
+
+    @staticmethod
+    def file_name(sketch_dim=128, seed=0):
+        return f"sketch_projection_{sketch_dim}_{seed}.npy"
+
+    @property
+    def nbytes(self):
+        return self.sketches.nbytes + self.projection.nbytes
+
+    def candidates(self, query_embedding, n):
+        query = np.asarray(query_embedding, dtype=np.float32).reshape(-1) @ self.projection
+        scores = self.sketches @ query
+        n = min(n, len(scores))
+        return np.argpartition(-scores, n - 1)[:n]
+
+def load_or_build_sketch(embeddings, kind="binary", store_path=None, sketch_dim=128, seed=0):
+    """
+    Load the sketch persisted next to a vector store (memory-mapped), or build and persist it
+
+    A persisted sketch is rebuilt if its row count no longer matches the store.
+    """
+    if kind not in SKETCH_KINDS:
+        raise ValueError(f"Unknown sketch kind: {kind}")
+
+    file_name = BinarySketch.file_name() if kind == "binary" else ProjectionSketch.file_name(sketch_dim, seed)
+    path = os.path.join(store_path, file_name) if store_path else None
+
+    data = None
+    if path and os.path.exists(path):
+        data = np.load(path, mmap_mode="r")
+        if len(data) != len(embeddings):
+            data = None
+
+    if kind == "binary":
+        sketch = BinarySketch(data) if data is not None else BinarySketch.build(embeddings)
+        array = sketch.codes
+    elif data is not None:
+        sketch = ProjectionSketch(data, ProjectionSketch.make_projection(embeddings.shape[1], sketch_dim, seed))
+        array = sketch.sketches
+    else:
+        sketch = ProjectionSketch.build(embeddings, sketch_dim, seed)
+        array = sketch.sketches
+
+    if path and data is None:
+        tmp_path = f"{path}.tmp.npy"
+        np.save(tmp_path, array)
+        os.replace(tmp_path, path)
+    return sketch
+
+def rerank_report(embeddings, sketch, query_embeddings, candidate_counts, k=10):
+    """
+    Recall@k and latency of sketch prefilter + exact rerank against exact search
+
+    Returns:
+        One dict per candidate count
+    """
+    matrix = np.asarray(embeddings, dtype=np.float32)
+    queries = np.atleast_2d(np.asarray(query_embeddings, dtype=np.float32))
+
+    exact_ids, exact_latencies = [], []
+    for query in queries:
+        start = time.perf_counter()
+        scores = matrix @ query
+        exact_ids.append(set(np.argpartition(-scores, k - 1)[:k].tolist()))
+        exact_latencies.append((time.perf_counter() - start) * 1000)
+
+    reports = []
+    for n in candidate_counts:
+        hits, latencies = 0, []
+        for query, expected in zip(queries, exact_ids):
+            start = time.perf_counter()
+            candidates = sketch.candidates(query, n)
+            scores = matrix[candidates] @ query
+            top = candidates[np.argpartition(-scores, min(k, len(scores)) - 1)[:k]]
+            latencies.append((time.perf_counter() - start) * 1000)
+            hits += len(expected & set(top.tolist()))
+
+        reports.append({
+            "kind": sketch.kind,
+            "candidates": n,
+            "k": k,
+            "recall_at_k": round(hits / (k * len(queries)), 4),
+            "exact_ms_p50": round(float(np.percentile(exact_latencies, 50)), 4),
+            "rerank_ms_p50": round(float(np.percentile(latencies, 50)), 4),
+            "rerank_ms_p95": round(float(np.percentile(latencies, 95)), 4)
+        })
+    return reports
+
+if __name__ == "__main__":
+    # Example: python -m utils.sketch_index vector_db/clinical_ctg-studies.pdf.store --kind binary
+    from .vector_store import load_vector_store
+
+    parser = argparse.ArgumentParser(description="Recall vs latency of prefilter-and-rerank against exact search")
+    parser.add_argument("store_path")
+    parser.add_argument("--kind", choices=SKETCH_KINDS, default="binary")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--candidates", type=int, nargs="+", default=[50, 100, 200, 400, 800])
+    args = parser.parse_args()
+
+    store = load_vector_store(args.store_path)
+    matrix = np.asarray(store.embeddings, dtype=np.float32)
+
+    # Perturbed corpus rows stand in for real queries
+    rng = np.random.default_rng(0)
+    sample = matrix[rng.choice(len(matrix), size=min(args.queries, len(matrix)), replace=False)]
+    sample = sample + rng.normal(scale=0.01, size=sample.shape).astype(np.float32)
+
+    sketch = load_or_build_sketch(matrix, kind=args.kind)
+    for report in rerank_report(matrix, sketch, sample, args.candidates, k=args.k):
+        print(json.dumps(report))
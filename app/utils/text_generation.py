@@ -1,50 +1,118 @@
-from transformers import T5ForConditionalGeneration, T5Tokenizer
+import torch
+from transformers import T5ForConditionalGeneration, T5Tokenizer, TextIteratorStreamer
+from transformers.modeling_outputs import BaseModelOutput
+from .cache import LRUCache
+from .context_builder import ContextBuilder
+
+NO_CONTEXT_RESPONSE = "I don't have enough information in my specialized knowledge base to answer this question."
 
 class TextGenerator:
     """Generate text responses using a pretrained language model"""
     
-    def __init__(self):
-        """Initialize with a text generation model"""
+    def __init__(self, max_input_tokens=512, encoder_cache_size=32, context_cache_size=20000):
+        """
+        Initialize with a text generation model
+        
+        Args:
+            max_input_tokens: Encoder token budget that retrieved context is packed into
+            encoder_cache_size: Number of encoder outputs kept for identical prompts
+            context_cache_size: Number of context chunks whose token ids are kept in memory
+        """
         try:
             self.model_name = "google/flan-t5-base"
             self.tokenizer = T5Tokenizer.from_pretrained(self.model_name)
             self.model = T5ForConditionalGeneration.from_pretrained(self.model_name)
+            self.model.eval()
             print(f"Loaded text generation model: {self.model_name}")
         except Exception as e:
             print(f"Error loading text generation model: {e}")
             raise
+        
+        self.context_builder = ContextBuilder(
+            self.tokenizer, self.model_name,
+            max_input_tokens=max_input_tokens, max_cached_chunks=context_cache_size
+        )
+        # Prompt token ids -> encoder hidden states, so identical context+query pairs skip the encoder
+        self.encoder_cache = LRUCache(max_size=encoder_cache_size)
     
-    def generate_response(self, query, context_docs, domain="general"):
-        """Generate response with proper handling of domain and context"""
+    def build_input_ids(self, query, context_docs, domain="general"):
+        """Prompt token ids for a query, or None when a specialized domain has no context to answer from"""
         # Format based on available context
         if context_docs and any(doc.get('content') for doc in context_docs):
-            # RAG approach - using retrieved documents
-            context_text = "\n\n".join([f"Document {i+1}: {doc['content']}" 
-                                      for i, doc in enumerate(context_docs[:3]) if doc.get('content')])
+            # RAG approach - pack the best retrieved documents into the token budget
+            return self.context_builder.build(query, context_docs)
+        
+        # No context documents available
+        if domain == "general":
+            # For general domain, allow the model to use its knowledge
+            return self.context_builder.build_plain(f"Answer this question: {query}")
+        
+        # For specialized domains, we need context documents
+        return None
+    
+    def _encode(self, batch_ids):
+        """
+        Pad a batch of prompts and run the encoder, reusing cached encoder outputs
+        
+        Returns:
+            (input_ids, attention_mask, encoder_outputs) ready for generate()
+        """
+        pad_id = self.tokenizer.pad_token_id
+        max_len = max(len(ids) for ids in batch_ids)
+        input_ids = torch.full((len(batch_ids), max_len), pad_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(batch_ids), max_len), dtype=torch.long)
+        for row, ids in enumerate(batch_ids):
+            input_ids[row, :len(ids)] = torch.tensor(ids, dtype=torch.long)
+            attention_mask[row, :len(ids)] = 1
+        
+        keys = [tuple(ids) for ids in batch_ids]
+        states = [self.encoder_cache.get(key) for key in keys]
+        missing = [row for row, state in enumerate(states) if state is None]
+        
+        with torch.no_grad():
+            if missing:
+                hidden = self.model.get_encoder()(
+                    input_ids=input_ids[missing],
+                    attention_mask=attention_mask[missing],
+                    return_dict=True
+                ).last_hidden_state
+                for j, row in enumerate(missing):
+                    states[row] = hidden[j, :len(batch_ids[row])].clone()
+                    self.encoder_cache.put(keys[row], states[row])
             
-            input_text = f"Based on this context, answer the question: {query}\n\nContext: {context_text}"
-        else:
-            # No context documents available
-            if domain == "general":
-                # For general domain, allow the model to use its knowledge
-                input_text = f"Answer this question: {query}"
-            else:
-                # For specialized domains, we need context documents
-                return {
-                    "response": "I don't have enough information in my specialized knowledge base to answer this question.",
-                    "sources": []
-                }
+            last_hidden_state = torch.zeros((len(batch_ids), max_len, states[0].shape[-1]), dtype=states[0].dtype)
+            for row, state in enumerate(states):
+                last_hidden_state[row, :state.shape[0]] = state
         
-        # Generate the response
-        try:
-            inputs = self.tokenizer(input_text, return_tensors="pt", max_length=512, truncation=True)
-            outputs = self.model.generate(
-                inputs.input_ids,
-                max_length=256,
+        return input_ids, attention_mask, BaseModelOutput(last_hidden_state=last_hidden_state)
+    
+    def _generate(self, batch_ids, max_length=256, streamer=None):
+        """Sample responses for a batch of prompt token ids"""
+        input_ids, attention_mask, encoder_outputs = self._encode(batch_ids)
+        with torch.no_grad():
+            return self.model.generate(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                encoder_outputs=encoder_outputs,
+                max_length=max_length,
                 do_sample=True,
                 temperature=0.7,
-                num_return_sequences=1
+                num_return_sequences=1,
+                streamer=streamer
             )
+    
+    def generate_response(self, query, context_docs, domain="general"):
+        """Generate response with proper handling of domain and context"""
+        input_ids = self.build_input_ids(query, context_docs, domain)
+        if input_ids is None:
+            return {
+                "response": NO_CONTEXT_RESPONSE,
+                "sources": []
+            }
+        
+        # Generate the response
+        try:
+            outputs = self._generate([input_ids])
             response = self.tokenizer.decode(outputs[0], skip_special_tokens=True)
             
             return {
@@ -57,3 +125,78 @@ class TextGenerator:
                 "response": f"I encountered an error while generating a response: {str(e)}",
                 "sources": []
             }
+    
+    def generate_batch(self, requests):
+        """
+        Generate responses for several requests in one padded generate() call
+        
+        Args:
+            requests: List of dicts with "query", "context_docs", "domain" and
+                      optional "max_length" (generated tokens, default 256) and
+                      "input_ids" (the prompt from build_input_ids(), if already built)
+            
+        Returns:
+            List of response dicts (as from generate_response), in request order
+        """
+        results = [None] * len(requests)
+        prompts, positions, max_lengths = [], [], []
+        
+        for i, request in enumerate(requests):
+            if "input_ids" in request:
+                input_ids = request["input_ids"]
+            else:
+                input_ids = self.build_input_ids(request["query"], request["context_docs"], request.get("domain", "general"))
+            if input_ids is None:
+                results[i] = {"response": NO_CONTEXT_RESPONSE, "sources": []}
+            else:
+                prompts.append(input_ids)
+                positions.append(i)
+                max_lengths.append(request.get("max_length") or 256)
+        
+        if not prompts:
+            return results
+        
+        try:
+            outputs = self._generate(prompts, max_length=max(max_lengths))
+            for row, (i, max_length) in enumerate(zip(positions, max_lengths)):
+                # Honour each request's own length limit within the shared batch
+                response = self.tokenizer.decode(outputs[row][:max_length], skip_special_tokens=True)
+                results[i] = {"response": response, "sources": requests[i]["context_docs"]}
+        except Exception as e:
+            print(f"Error generating batched responses: {e}")
+            for i in positions:
+                results[i] = {
+                    "response": f"I encountered an error while generating a response: {str(e)}",
+                    "sources": []
+                }
+        
+        return results
+    
+    def prepare_stream(self, query, context_docs, domain="general", max_length=256, timeout=60, input_ids=None):
+        """
+        Set up token streaming without starting generation
+        
+        Args:
+            max_length: Most tokens generated
+            input_ids: Prompt token ids from build_input_ids(), if already built
+            
+        Returns:
+            (streamer, generate): iterating the streamer yields decoded text pieces
+            as they are produced, once generate() - a blocking call - is running.
+            Returns (None, None) when there is no context to answer from.
+        """
+        if input_ids is None:
+            input_ids = self.build_input_ids(query, context_docs, domain)
+        if input_ids is None:
+            return None, None
+        
+        streamer = TextIteratorStreamer(self.tokenizer, timeout=timeout, skip_special_tokens=True)
+        
+        def generate():
+            try:
+                self._generate([input_ids], max_length=max_length, streamer=streamer)
+            finally:
+                # Unblock the consumer even if generation failed
+                streamer.end()
+        
+        return streamer, generate
@@ -0,0 +1,138 @@
+import numpy as np
+from .bm25_index import BM25Index
+from .vector_store import VectorStore
+
+def top_k_indices(scores, top_k, threshold=None):
+    """
+    Indices of the top_k highest scores (descending) using partial selection
+
+    Args:
+        scores: Array of per-document scores
+        top_k: Number of indices to return
+        threshold: Optional minimum score (exclusive)
+    """
+    candidates = np.arange(len(scores))
+    if threshold is not None:
+        candidates = np.flatnonzero(scores > threshold)
+    if not len(candidates) or top_k <= 0:
+        return candidates[:0]
+
+    if len(candidates) > top_k:
+        part = np.argpartition(-scores[candidates], top_k - 1)[:top_k]
+        candidates = candidates[part]
+
+    return candidates[np.argsort(-scores[candidates], kind="stable")]
+
+class DomainIndex:
+    """Contiguous, pre-normalized embedding matrix for a single domain collection"""
+
+    def __init__(self, documents):
+        """
+        Compile a collection into parallel arrays
+
+        Args:
+            documents: A VectorStore, or a list of {"content", "embedding", "metadata"} dicts
+        """
+        store = documents if isinstance(documents, VectorStore) else VectorStore.from_documents(documents)
+
+        self.contents = store.contents
+        self.metadatas = store.metadatas
+        self.store_path = store.path
+        # Optional approximate nearest-neighbour index (see attach_ann)
+        self.ann = None
+        # Optional compact sketch for prefilter-and-rerank retrieval (see attach_sketch)
+        self.sketch = None
+
+        if not len(store):
+            self.embeddings = np.zeros((0, 0), dtype=np.float32)
+        elif store.normalized and store.embeddings.dtype == np.float32:
+            # Use the (possibly memory-mapped) matrix as-is so its pages stay shared
+            self.embeddings = store.embeddings
+        else:
+            matrix = np.asarray(store.embeddings, dtype=np.float32)
+            norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+            self.embeddings = np.ascontiguousarray(matrix / np.maximum(norms, 1e-12))
+
+        # Inverted index for keyword scoring, persisted with the store when possible
+        self.bm25 = BM25Index.load(self.store_path) if self.store_path else None
+        if self.bm25 is None or len(self.bm25) != len(self):
+            self.bm25 = BM25Index.build(self.contents)
+            if self.store_path:
+                self.bm25.save(self.store_path)
+
+    def __len__(self):
+        return len(self.contents)
+
+    def embedding_blocks(self):
+        """The collection's embedding matrices (one here), e.g. for computing domain centroids"""
+        return [self.embeddings] if len(self) else []
+
+    def memory_bytes(self):
+        """Bytes of the embedding matrix (mapped, for memory-mapped stores), BM25 postings and sketch"""
+        total = self.embeddings.nbytes
+        if self.bm25 is not None:
+            total += self.bm25.offsets.nbytes + self.bm25.doc_ids.nbytes + self.bm25.weights.nbytes
+        if self.sketch is not None:
+            total += self.sketch.nbytes
+        return total
+
+    def similarities(self, query_embedding, doc_ids=None):
+        """
+        Cosine similarity of the query against every document, as one matrix-vector product
+
+        Args:
+            query_embedding: Query embedding
+            doc_ids: Optional candidate rows to score instead of the whole collection
+        """
+        if not len(self):
+            return np.zeros(0, dtype=np.float32)
+
+        query = np.asarray(query_embedding, dtype=np.float32).reshape(-1)
+        query = query / max(float(np.linalg.norm(query)), 1e-12)
+        if doc_ids is not None:
+            return self.embeddings[doc_ids] @ query
+        return self.embeddings @ query
+
+    def attach_ann(self, kind, build_params=None, **search_params):
+        """Build or load a FAISS index for this collection, persisted next to its store"""
+        from .ann_index import FaissIndex
+
+        if len(self):
+            self.ann = FaissIndex.load_or_build(
+                self.embeddings, kind=kind, store_path=self.store_path,
+                build_params=build_params, **search_params
+            )
+
+    def ann_search(self, query_embedding, k):
+        """
+        Dense candidates from the ANN index
+
+        Returns:
+            (similarities, doc_ids) arrays for the approximate top-k documents
+        """
+        scores, ids = self.ann.search(query_embedding, k)
+        found = ids[0] >= 0
+        return scores[0][found], ids[0][found]
+
+    def attach_sketch(self, kind, **sketch_params):
+        """Build or load a binary / projection sketch for this collection, persisted next to its store"""
+        from .sketch_index import load_or_build_sketch
+
+        if len(self):
+            self.sketch = load_or_build_sketch(
+                self.embeddings, kind=kind, store_path=self.store_path, **sketch_params
+            )
+
+    def sketch_candidates(self, query_embedding, n):
+        """Ids of the n documents closest to the query under the cheap sketch (unordered)"""
+        return self.sketch.candidates(query_embedding, n)
+
+    def keyword_boost(self, key_terms):
+        """Normalized BM25 score of each document for the query's key terms"""
+        if not len(self) or not key_terms:
+            return np.zeros(len(self), dtype=np.float32)
+        return self.bm25.score(key_terms)
+
+    def top_k(self, scores, top_k, threshold=None):
+        """Indices of the top_k highest scores (descending), see top_k_indices"""
+        return top_k_indices(scores, top_k, threshold)
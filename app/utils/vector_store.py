@@ -0,0 +1,237 @@
+import json
+import os
+import shutil
+import numpy as np
+from .ingestion_manifest import MANIFEST_FILE
+
+FORMAT_VERSION = 1
+
+EMBEDDINGS_FILE = "embeddings.npy"
+TEXTS_FILE = "texts.bin"
+OFFSETS_FILE = "offsets.npy"
+METADATA_FILE = "metadata.json"
+
+class VectorStore:
+    """
+    Columnar vector store: one embedding matrix plus parallel content and metadata columns
+
+    Iterating yields the same {"content", "embedding", "metadata"} dicts the
+    pickle store used to hold, so existing callers keep working.
+    """
+
+    def __init__(self, embeddings, contents, metadatas, normalized=True, path=None, manifest=None):
+        self.embeddings = embeddings
+        self.contents = contents
+        self.metadatas = metadatas
+        self.normalized = normalized
+        # Directory the store was loaded from; None for in-memory stores
+        self.path = path
+        # Ingestion manifest describing how the store was built, if any
+        self.manifest = manifest
+
+    def __len__(self):
+        return len(self.contents)
+
+    def __getitem__(self, i):
+        return {
+            "content": self.contents[i],
+            "embedding": self.embeddings[i],
+            "metadata": self.metadatas[i]
+        }
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    @classmethod
+    def from_documents(cls, documents):
+        """Build an in-memory store from a list of document dicts"""
+        documents = [doc for doc in documents if "embedding" in doc]
+        if documents:
+            embeddings = np.vstack([np.asarray(doc["embedding"], dtype=np.float32) for doc in documents])
+        else:
+            embeddings = np.zeros((0, 0), dtype=np.float32)
+        return cls(
+            embeddings,
+            [doc["content"] for doc in documents],
+            [doc.get("metadata", {}) for doc in documents],
+            normalized=False
+        )
+
+    @classmethod
+    def concatenate(cls, stores):
+        """Merge several stores (e.g. one per PDF) into a single in-memory store"""
+        stores = [store for store in stores if len(store)]
+        if len(stores) == 1:
+            return stores[0]
+        if not stores:
+            return cls(np.zeros((0, 0), dtype=np.float32), [], [])
+
+        return cls(
+            np.vstack([np.asarray(store.embeddings, dtype=np.float32) for store in stores]),
+            [content for store in stores for content in store.contents],
+            [metadata for store in stores for metadata in store.metadatas],
+            normalized=all(store.normalized for store in stores)
+        )
+
+class TextColumn:
+    """Read-only sequence of chunk texts decoded on access from a memory-mapped texts.bin"""
+
+    def __init__(self, data, offsets):
+        self.data = data
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        return bytes(self.data[self.offsets[i]:self.offsets[i + 1]]).decode("utf-8")
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+def save_vector_store(path, contents, embeddings, metadatas, dtype="float32", normalized=True, manifest=None):
+    """
+    Write a columnar vector store directory
+
+    The store is written to a temporary directory and renamed into place so
+    readers never observe a half-written store.
+
+    Args:
+        path: Store directory to create
+        contents: List of chunk texts
+        embeddings: Sequence of embedding vectors (or a 2-D array)
+        metadatas: List of per-chunk metadata dicts
+        dtype: "float32" or "float16" for the on-disk embedding matrix
+        normalized: Whether the embeddings are already L2-normalized
+        manifest: Optional ingestion manifest written alongside the store
+    """
+    matrix = np.asarray(np.vstack(embeddings) if len(embeddings) else np.zeros((0, 0)), dtype=dtype)
+
+    encoded = [content.encode("utf-8") for content in contents]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(chunk) for chunk in encoded])
+
+    tmp_path = f"{path}.tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+
+    np.save(os.path.join(tmp_path, EMBEDDINGS_FILE), matrix)
+    np.save(os.path.join(tmp_path, OFFSETS_FILE), offsets)
+    with open(os.path.join(tmp_path, TEXTS_FILE), "wb") as f:
+        f.write(b"".join(encoded))
+    with open(os.path.join(tmp_path, METADATA_FILE), "w") as f:
+        json.dump({
+            "format_version": FORMAT_VERSION,
+            "count": len(encoded),
+            "dim": int(matrix.shape[1]) if matrix.ndim == 2 else 0,
+            "dtype": str(matrix.dtype),
+            "normalized": normalized,
+            "metadata": metadatas
+        }, f)
+    if manifest is not None:
+        with open(os.path.join(tmp_path, MANIFEST_FILE), "w") as f:
+            json.dump(manifest, f)
+
+    if os.path.exists(path):
+        old_path = f"{path}.old"
+        shutil.rmtree(old_path, ignore_errors=True)
+        os.replace(path, old_path)
+        os.replace(tmp_path, path)
+        shutil.rmtree(old_path, ignore_errors=True)
+    else:
+        os.replace(tmp_path, path)
+
+def load_vector_store(path, mmap=True, lazy_texts=False):
+    """
+    Open a columnar vector store directory
+
+    The embedding matrix is memory-mapped read-only, so loading is near-instant
+    and pages are shared between worker processes through the OS page cache.
+    With lazy_texts, chunk texts stay memory-mapped too and are decoded on access.
+    """
+    with open(os.path.join(path, METADATA_FILE)) as f:
+        header = json.load(f)
+    if header.get("format_version") != FORMAT_VERSION:
+        raise ValueError(f"Unsupported vector store format: {header.get('format_version')}")
+
+    # Empty files cannot be memory-mapped
+    use_mmap = mmap and header["count"] > 0
+    embeddings = np.load(os.path.join(path, EMBEDDINGS_FILE), mmap_mode="r" if use_mmap else None)
+    offsets = np.load(os.path.join(path, OFFSETS_FILE))
+    if lazy_texts and use_mmap and offsets[-1] > 0:
+        contents = TextColumn(np.memmap(os.path.join(path, TEXTS_FILE), dtype=np.uint8, mode="r"), offsets)
+    else:
+        with open(os.path.join(path, TEXTS_FILE), "rb") as f:
+            data = f.read()
+        contents = [data[offsets[i]:offsets[i + 1]].decode("utf-8") for i in range(len(offsets) - 1)]
+
+    manifest = None
+    manifest_path = os.path.join(path, MANIFEST_FILE)
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+
+    return VectorStore(
+        embeddings,
+        contents,
+        header["metadata"],
+        normalized=header.get("normalized", False),
+        path=path,
+        manifest=manifest
+    )
+
+def link_vector_store(src, dst):
+    """
+    Copy a store directory by hard-linking its files (copying across filesystems)
+
+    Safe because stores are never modified in place: every writer replaces
+    files by renaming, so the copies diverge as soon as either is rewritten.
+    """
+    tmp_path = f"{dst}.tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    for name in os.listdir(src):
+        source = os.path.join(src, name)
+        if not os.path.isfile(source):
+            continue
+        try:
+            os.link(source, os.path.join(tmp_path, name))
+        except OSError:
+            shutil.copy2(source, os.path.join(tmp_path, name))
+    os.replace(tmp_path, dst)
+
+def is_vector_store(path):
+    return os.path.isfile(os.path.join(path, METADATA_FILE))
+
+def save_token_column(path, name, token_lists):
+    """
+    Persist per-chunk token ids for a tokenizer alongside a store
+
+    Args:
+        path: Store directory
+        name: Tokenizer name the ids belong to
+        token_lists: One list of token ids per store row
+    """
+    prefix = os.path.join(path, f"tokens_{name.replace('/', '__')}")
+    offsets = np.zeros(len(token_lists) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(ids) for ids in token_lists])
+    flat = np.fromiter((token for ids in token_lists for token in ids), dtype=np.int32, count=int(offsets[-1]))
+
+    np.save(f"{prefix}.ids.tmp.npy", flat)
+    np.save(f"{prefix}.offsets.tmp.npy", offsets)
+    os.replace(f"{prefix}.ids.tmp.npy", f"{prefix}.ids.npy")
+    os.replace(f"{prefix}.offsets.tmp.npy", f"{prefix}.offsets.npy")
+
+def load_token_column(path, name):
+    """Per-chunk token id arrays for a tokenizer, or None if not persisted"""
+    prefix = os.path.join(path, f"tokens_{name.replace('/', '__')}")
+    if not (os.path.exists(f"{prefix}.ids.npy") and os.path.exists(f"{prefix}.offsets.npy")):
+        return None
+
+    flat = np.load(f"{prefix}.ids.npy")
+    offsets = np.load(f"{prefix}.offsets.npy")
+    return [flat[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)]